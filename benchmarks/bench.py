@@ -0,0 +1,376 @@
+"""Benchmarks of the montecarlo hot functions and of end-to-end runs per
+engine, on a synthetic model (see synthetic.py).
+
+    python benchmarks/bench.py --agents 1000 -o before.json
+    python benchmarks/bench.py --agents 1000 -o after.json --compare before.json
+
+Each benchmark reports operations per second (best of --repeat) and the
+peak memory allocated by one more, traced, repetition."""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Text, Tuple
+
+import synthetic
+import tabulate
+
+from provreq.mcmc.aggregators import children, equivalence
+from provreq.mcmc.aggregators.online import path_aggregation
+from provreq.mcmc.create_stats import count_bundle
+from provreq.mcmc.graph import AgentGraph
+from provreq.mcmc.montecarlo import (
+    BATCH_SIZE,
+    Query,
+    Run,
+    montecarlo,
+    sample_agent,
+    setup_worker,
+    validates,
+    worker_rng_states,
+)
+from provreq.mcmc.sketch import HeavyHitters
+
+# A benchmark prepares (untimed) and returns the function to time, which
+# runs the number of operations given with the benchmark. A dict of JSON
+# scalars (metric -> value) returned by the function is added to the results
+Benchmark = Tuple[Callable[[], Callable[[], Any]], int]
+
+
+def command_line_arguments() -> argparse.Namespace:
+    """Parse the command line arguments"""
+
+    parser = argparse.ArgumentParser(description="provreq-mcmc benchmarks")
+
+    parser.add_argument("--agents", type=int, default=200, help="Number of agents")
+    parser.add_argument("--depth", type=int, default=6, help="Layers of agents")
+    parser.add_argument(
+        "--fan-in", type=int, default=2, help="Promises required by each agent"
+    )
+    parser.add_argument(
+        "--fan-out", type=int, default=2, help="Promises provided by each agent"
+    )
+    parser.add_argument(
+        "--children", type=float, default=0.2, help="Share of agents with a child"
+    )
+    parser.add_argument(
+        "--unknown",
+        type=float,
+        default=0.05,
+        help="Share of promises with a provider that is not an agent",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument(
+        "--number",
+        type=int,
+        default=10_000,
+        help="Operations of each micro benchmark, default: 10000",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=20_000,
+        help="Accepted runs of the end-to-end benchmarks, default: 20000",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Repetitions (best is used)"
+    )
+    parser.add_argument(
+        "--only", type=str, help="Only run benchmarks with names containing this"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="benchmark.json",
+        help="Store results (JSON), default: benchmark.json",
+    )
+    parser.add_argument(
+        "--compare", type=str, help="Compare with the results in this file"
+    )
+
+    return parser.parse_args()
+
+
+def engines() -> List[Text]:
+    """The engines that can run here, numpy is optional"""
+
+    if importlib.util.find_spec("numpy") is None:
+        return ["reference"]
+
+    return ["reference", "numpy"]
+
+
+def benchmarks(args: argparse.Namespace) -> Dict[Text, Benchmark]:
+    """Create the model and the benchmarks"""
+
+    model = synthetic.generate(
+        args.agents,
+        args.depth,
+        args.fan_in,
+        args.fan_out,
+        args.children,
+        args.unknown,
+        args.seed,
+    )
+    agents, stats = model.agents, model.stats
+
+    full_graph = AgentGraph.compile(agents, stats)
+    seeds_mask = full_graph.promise_mask(model.seeds)
+    graph, _ = full_graph.prune()
+    base = graph.agent_mask([model.target])
+    stop_agents = graph.agent_mask(model.stop_agents)
+    query = Query(tuple(model.seeds), base, stop_agents)
+
+    number = args.number
+    requiring = [idx for idx, requires in enumerate(graph.requires) if requires]
+
+    # chains and accepted paths used by the validation and aggregation
+    # benchmarks
+    rng = random.Random(args.seed)
+    sims = [
+        montecarlo(graph, base, stop_agents, seeds_mask, rng, Counter())
+        for _ in range(number)
+    ]
+    accepted = [sim for sim in sims if sim is not None]
+    chains = [graph.agent_names(sim) for sim in accepted]
+    if not chains:
+        # the end-to-end runs would never finish
+        sys.stderr.write("No chain reaches a stop agent on this model\n")
+        sys.exit(1)
+    paths = Counter(frozenset(chain) for chain in chains)
+    incidents = synthetic.bundles(model, number // 10, seed=args.seed)
+
+    def compile_graph() -> Callable[[], Any]:
+        return lambda: AgentGraph.compile(agents, stats)
+
+    def prune() -> Callable[[], Any]:
+        return lambda: full_graph.prune(full_graph.reachable(seeds_mask))
+
+    def sample() -> Callable[[], Any]:
+        def run() -> None:
+            rng = random.Random(args.seed)
+            for idx in range(number):
+                sample_agent(requiring[idx % len(requiring)], graph, seeds_mask, rng)
+
+        return run
+
+    def chain() -> Callable[[], Any]:
+        def run() -> None:
+            rng = random.Random(args.seed)
+            for _ in range(number):
+                montecarlo(graph, base, stop_agents, seeds_mask, rng, Counter())
+
+        return run
+
+    def validate() -> Callable[[], Any]:
+        def run() -> None:
+            for idx in range(number):
+                validates(model.seeds, chains[idx % len(chains)], agents, [])
+
+        return run
+
+    def aggregate_children() -> Callable[[], Any]:
+        return lambda: {"distinct": len(children.aggregate(agents, paths))}
+
+    def aggregate_equivalence() -> Callable[[], Any]:
+        return lambda: {"distinct": len(equivalence.aggregate(agents, paths))}
+
+    def aggregate_online() -> Callable[[], Any]:
+        aggregation = path_aggregation(graph, agents, "equivalence")
+
+        def run() -> None:
+            for sim in accepted:
+                aggregation(sim)
+
+        return run
+
+    def heavy_hitters() -> Callable[[], Any]:
+        batch = Counter(accepted)
+        return lambda: HeavyHitters(100).update(batch)
+
+    def count_bundles() -> Callable[[], Any]:
+        def run() -> None:
+            output: Dict[Text, Dict[Text, int]] = {}
+            for bundle in incidents:
+                count_bundle(bundle, agents, output, set())
+
+        return run
+
+    res: Dict[Text, Benchmark] = {
+        "compile": (compile_graph, 1),
+        "prune": (prune, 1),
+        "sample_agent": (sample, number),
+        "montecarlo": (chain, number),
+        "validates": (validate, number),
+        "aggregate children": (aggregate_children, len(paths)),
+        "aggregate equivalence": (aggregate_equivalence, len(paths)),
+        "aggregate online equivalence": (aggregate_online, len(accepted)),
+        "heavy hitters": (heavy_hitters, len(accepted)),
+        "count_bundle": (count_bundles, len(incidents)),
+    }
+
+    for engine in engines():
+
+        def end_to_end(engine: Text = engine) -> Callable[[], Any]:
+            # a fresh worker, so the validation cache starts empty
+            setup_worker(full_graph, agents, engine)
+            run = Run(query, worker_rng_states(args.seed, 1))
+
+            def simulate() -> Dict[Text, Any]:
+                while run.accepted < args.runs:
+                    run.batch(min(args.runs - run.accepted, BATCH_SIZE))
+                return {"attempts": run.attempted, "paths": len(run.paths)}
+
+            return simulate
+
+        res[f"end-to-end {engine}"] = (end_to_end, args.runs)
+
+    if engines() == ["reference", "numpy"]:
+        from provreq.mcmc.numpyengine import NumpyEngine
+
+        def numpy_chains() -> Callable[[], Any]:
+            import numpy
+
+            engine = NumpyEngine(graph, base, stop_agents, seeds_mask)
+            nprng = numpy.random.default_rng(args.seed)
+            return lambda: engine.run(number, nprng)
+
+        res["numpy engine"] = (numpy_chains, number)
+
+    return res
+
+
+def measure(benchmark: Benchmark, repeat: int) -> Dict[Text, Any]:
+    """Best time of repeat runs of benchmark, and the peak memory allocated
+    by a traced run"""
+
+    prepare, ops = benchmark
+
+    best = float("inf")
+    for _ in range(repeat):
+        run = prepare()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+
+    run = prepare()
+    tracemalloc.start()
+    try:
+        extra = run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "ops": ops,
+        "seconds": best,
+        "ops_per_s": ops / best if best else None,
+        "peak_kib": round(peak / 1024, 1),
+        **(
+            {
+                key: value
+                for key, value in extra.items()
+                if isinstance(value, (bool, int, float, str))
+            }
+            if isinstance(extra, dict)
+            else {}
+        ),
+    }
+
+
+def commit() -> Optional[Text]:
+    """The current git commit, if any"""
+
+    try:
+        return subprocess.run(
+            [
+                "git",
+                "-C",
+                os.path.dirname(__file__) or ".",
+                "rev-parse",
+                "--short",
+                "HEAD",
+            ],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    """main entry point"""
+
+    args = command_line_arguments()
+
+    params = {
+        name: getattr(args, name)
+        for name in [
+            "agents",
+            "depth",
+            "fan_in",
+            "fan_out",
+            "children",
+            "unknown",
+            "seed",
+            "number",
+            "runs",
+        ]
+    }
+
+    previous: Dict[Text, Any] = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file_handle:
+            previous = json.load(file_handle)
+        if previous.get("params") != params:
+            print(f"Warning: {args.compare} was run with other parameters")
+
+    results = {}
+    rows = []
+    for name, benchmark in benchmarks(args).items():
+        if args.only and args.only not in name:
+            continue
+        results[name] = result = measure(benchmark, args.repeat)
+
+        row = [name, round(result["ops_per_s"] or 0), result["peak_kib"]]
+        old = previous.get("results", {}).get(name)
+        if previous:
+            row.append(
+                f"{(result['ops_per_s'] / old['ops_per_s'] - 1) * 100:+.1f}%"
+                if old and old["ops_per_s"] and result["ops_per_s"]
+                else None
+            )
+        rows.append(row)
+        print(f"{name}: {row[1]} ops/s", file=sys.stderr)
+
+    headers = ["benchmark", "ops/s", "peak KiB"]
+    if previous:
+        headers.append(f"vs {previous.get('commit') or args.compare}")
+    print(tabulate.tabulate(rows, headers=headers, tablefmt="fancy_grid"))
+
+    with open(args.output, "w", encoding="utf-8") as file_handle:
+        json.dump(
+            {
+                "commit": commit(),
+                "python": platform.python_version(),
+                "params": params,
+                "results": results,
+            },
+            file_handle,
+            indent=2,
+        )
+    sys.stderr.write("writing %s\n" % args.output)
+
+
+if __name__ == "__main__":
+    main()
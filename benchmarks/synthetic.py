@@ -0,0 +1,151 @@
+"""Seeded generator of synthetic agents, promises and stats, shaped like the
+AEP agent promises: layers of agents where each layer requires promises
+provided by the layers before it. Layer 0 (Reconnaissance) requires
+nothing and provides the seeds, layer 1 is Initial Access (the stop
+agents) and the target agent is in the last layer."""
+
+import random
+from typing import Dict, List, NamedTuple, Text
+
+from provreq.tools.libs.data import expand_agents
+
+CLASSES = [
+    "Execution",
+    "Persistence",
+    "Privilege Escalation",
+    "Defense Evasion",
+    "Credential Access",
+    "Discovery",
+    "Lateral Movement",
+    "Collection",
+    "Command and Control",
+    "Exfiltration",
+    "Impact",
+]
+
+
+class Synthetic(NamedTuple):
+    """Generated agents (children expanded), stats and the query"""
+
+    agents: Dict[Text, Dict]
+    stats: Dict[Text, Dict[Text, int]]
+    seeds: List[Text]
+    stop_agents: List[Text]
+    target: Text
+
+
+def layer_class(layer: int) -> Text:
+    """Agent class of the agents in a layer"""
+
+    if layer == 0:
+        return "Reconnaissance"
+    if layer == 1:
+        return "Initial Access"
+    return CLASSES[(layer - 2) % len(CLASSES)]
+
+
+def generate(
+    agents: int = 200,
+    depth: int = 6,
+    fan_in: int = 2,
+    fan_out: int = 2,
+    children: float = 0.2,
+    unknown: float = 0.05,
+    seed: int = 1,
+) -> Synthetic:
+    """Generate about agents agents in depth layers. Each agent requires
+    fan_in promises (mostly from the layer before) and provides fan_out
+    promises of its own layer. A share of the agents (children) get a
+    sub-agent, and a share of the promises (unknown) also get a provider
+    in the stats that is not an agent"""
+
+    if depth < 2:
+        raise ValueError("depth must be at least 2 (seeds and stop agents)")
+
+    rng = random.Random(seed)
+    per_layer = max(1, agents // depth)
+    n_promises = max(2, per_layer * fan_out // 2)
+
+    promises = [
+        [f"l{layer}_p{idx}" for idx in range(n_promises)] for layer in range(depth)
+    ]
+
+    generated: Dict[Text, Dict] = {}
+    layers: List[List[Text]] = []
+    for layer in range(depth):
+        layer_agents = []
+        for idx in range(per_layer):
+            agent_id = f"T{layer:02d}{idx:04d}"
+            requires: List[Text] = []
+            if layer:
+                for _ in range(fan_in):
+                    # mostly the layer before, sometimes any earlier layer
+                    source = layer - 1 if rng.random() < 0.8 else rng.randrange(layer)
+                    requires.append(rng.choice(promises[source]))
+            # every promise of the layer has at least one provider, so all
+            # agents can be activated from the seeds
+            provides = {
+                promises[layer][prom] for prom in range(idx, n_promises, per_layer)
+            }
+            if len(provides) < fan_out:
+                provides.update(
+                    rng.sample(
+                        promises[layer], min(fan_out - len(provides), n_promises)
+                    )
+                )
+
+            agent = {
+                "name": f"Agent {agent_id}",
+                "requires": sorted(set(requires)),
+                "provides": sorted(provides),
+                "conditional_provides": {},
+                "agent_class": [layer_class(layer)],
+                "tactic": [layer_class(layer)],
+                "mitigations": [],
+                "relevant_for": [],
+                "children": {},
+            }
+            if rng.random() < children:
+                agent["children"][f"{agent_id}.001"] = {
+                    "name": "sub",
+                    "requires": agent["requires"],
+                    "provides": agent["provides"],
+                }
+            generated[agent_id] = agent
+            layer_agents.append(agent_id)
+        layers.append(layer_agents)
+
+    generated.update(expand_agents(generated))
+
+    stats: Dict[Text, Dict[Text, int]] = {}
+    for agent_id, agent in generated.items():
+        for prom in agent["provides"]:
+            stats.setdefault(prom, {})[agent_id] = rng.randint(1, 100)
+    for prom, providers in stats.items():
+        if rng.random() < unknown:
+            providers[f"X{rng.randrange(10000):04d}"] = rng.randint(1, 10)
+
+    initial_access = set(layers[1])
+
+    return Synthetic(
+        generated,
+        stats,
+        list(promises[0]),
+        [agent for agent in generated if agent.split(".")[0] in initial_access],
+        layers[-1][0],
+    )
+
+
+def bundles(
+    synthetic: Synthetic, n: int, size: int = 8, seed: int = 1
+) -> List[Dict[Text, List[Text]]]:
+    """Random incident bundles (name -> agents) of about size agents, as
+    read by the data readers"""
+
+    rng = random.Random(seed)
+    agent_ids = list(synthetic.agents)
+
+    return [
+        {f"incident-{idx}": rng.sample(agent_ids, min(len(agent_ids), size))}
+        for idx in range(n)
+    ]
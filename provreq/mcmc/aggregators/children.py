@@ -1,6 +1,7 @@
 """Aggregate a set of simulations based on primary agent"""
 
 from collections import Counter
+from typing import Dict
 
 
 def aggregate(_: dict, data: Counter) -> Counter:
@@ -15,3 +16,9 @@ def aggregate(_: dict, data: Counter) -> Counter:
         c[frozenset(newsim)] += n
 
     return c
+
+
+def classes(agents: dict) -> Dict[str, str]:
+    """The parent agent of each agent"""
+
+    return {agent_id: agent_id.split(".")[0] for agent_id in agents}
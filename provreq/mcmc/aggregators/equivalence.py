@@ -2,14 +2,20 @@
 in they require and provide, """
 
 from collections import Counter
-from typing import Optional
+from typing import Dict, Optional, Tuple
+
+
+def signature(agent: dict) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """The sorted provides and requires of an agent, agents with the same
+    signature are equivalent"""
+
+    return tuple(sorted(agent["provides"])), tuple(sorted(agent["requires"]))
 
 
 def aggrid(agent: dict) -> str:
     """Create an ID based on the values in provides and requires"""
 
-    prov = sorted(agent["provides"])
-    req = sorted(agent["requires"])
+    prov, req = signature(agent)
     return f"p:{'$$'.join(prov)}//r:{'$$'.join(req)}"
 
 
@@ -22,6 +28,8 @@ def assimilate(aggragent: Optional[dict], agentID: str, agent: dict) -> dict:
     if aggragent is None:
         agent["aggregated"] = [agentID]
         agent["name"] = "Aggr:\n   " + agent["name"]
+        if "subagents" in agent:
+            agent["subagents"] = dict(agent["subagents"])
         return agent
     aggragent["aggregated"].append(agentID)
     aggragent["name"] += "\n   " + agent["name"]
@@ -43,44 +51,65 @@ def assimilate(aggragent: Optional[dict], agentID: str, agent: dict) -> dict:
     return aggragent
 
 
+class EquivalenceIndex:
+    """The classes of (more than one) equivalent agents. classes maps each
+    agent in a class to the aggrid of the class, and aggregated the aggrid
+    to the aggregated agent. The agents are not changed"""
+
+    def __init__(self, agents: dict) -> None:
+        members: Dict[Tuple, list] = {}
+        for agent_id, agent in agents.items():
+            members.setdefault(signature(agent), []).append(agent_id)
+
+        self.classes: Dict[str, str] = {}
+        self.aggregated: Dict[str, dict] = {}
+        for agent_ids in members.values():
+            if len(agent_ids) <= 1:
+                continue
+
+            aggragent = None
+            for agent_id in agent_ids:
+                aggragent = assimilate(aggragent, agent_id, agents[agent_id])
+
+            class_id = aggrid(agents[agent_ids[0]])
+            self.aggregated[class_id] = aggragent  # type: ignore
+            for agent_id in agent_ids:
+                self.classes[agent_id] = class_id
+
+    def merged(self, agents: dict) -> dict:
+        """A new dictionary of the agents and the aggregated agents"""
+
+        return {**agents, **self.aggregated}
+
+    def remap(self, data: Counter) -> Counter:
+        """Replace the agents of each simulation with their class"""
+
+        classes = self.classes
+
+        c: Counter = Counter()
+        for sim, n in data.items():
+            c[frozenset(classes.get(agent_id, agent_id) for agent_id in sim)] += n
+
+        return c
+
+
 def create_aggregated_agents(agents: dict) -> dict:
     """create new aggregated agents from an existing agents dictionary,
     based on the agents having the same effect on a simulation from having
-    the same provides and requires lists."""
-
-    for agent_id in list(agents.keys()):
-        agent = agents[agent_id]
-        if aggrid(agent) in agents:
-            aggragent = agents[aggrid(agent)]
-            aggragent = assimilate(aggragent, agent_id, agent)
-        else:
-            aggragent = assimilate(None, agent_id, agent)
-        agents[aggrid(agent)] = aggragent
-
-    # remove any potensial aggregations that only contains the original
-    # agent (no more than one agent has been aggregated to this ID)
-    for agent_id in list(agents.keys()):
-        agent = agents[agent_id]
-        if "aggregated" in agent and len(agent["aggregated"]) <= 1:
-            agents.pop(agent_id)
+    the same provides and requires lists. The aggregated agents are added
+    to agents"""
+
+    agents.update(EquivalenceIndex(agents).aggregated)
     return agents
 
 
 def aggregate(agents: dict, data: Counter) -> Counter:
     """Aggregate the simulation based on the agents being equivalent"""
 
-    agents = create_aggregated_agents(agents)
+    return EquivalenceIndex(agents).remap(data)
 
-    c: Counter = Counter()
 
-    for sim, n in data.items():
-        newsim = set()
-        for agentID in sim:
-            agent = agents[agentID]
-            if aggrid(agent) in agents:
-                newsim.add(aggrid(agent))
-            else:
-                newsim.add(agentID)
-        c[frozenset(newsim)] += n
+def classes(agents: dict) -> Dict[str, str]:
+    """The aggrid of each agent in a class of equivalent agents"""
 
-    return c
+    return EquivalenceIndex(agents).classes
@@ -0,0 +1,98 @@
+"""Aggregation of paths (agent bitmasks over the graph) as they are
+recorded. The agents of a class (the children of an agent, or equivalent
+agents) are replaced with one representative agent of the class, so the
+paths stay bitmasks and the counter of paths only grows with the number of
+distinct aggregated paths"""
+
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Set, Text
+
+import provreq.mcmc.aggregators.children
+import provreq.mcmc.aggregators.equivalence
+from provreq.mcmc.graph import AgentGraph, bits
+
+# agents -> the class of each agent (missing agents are their own class)
+STRATEGIES: Dict[Text, Callable[[dict], Dict[str, str]]] = {
+    "children": provreq.mcmc.aggregators.children.classes,
+    "equivalence": provreq.mcmc.aggregators.equivalence.classes,
+}
+
+
+class PathAggregation:
+    """Replace the agents of paths with the first agent (in graph order) of
+    their class. labels is the class of each agent, as reported"""
+
+    def __init__(self, graph: AgentGraph, classes: Dict[str, str]) -> None:
+        representative: Dict[Text, int] = {}
+        self.agent_ids = graph.agent_ids
+        self.labels: List[Text] = []
+        # bitmask of the agents that are replaced, and their replacement
+        self.moved = 0
+        self.replacement: Dict[int, int] = {}
+        for idx, agent_id in enumerate(graph.agent_ids):
+            label = classes.get(agent_id, agent_id)
+            self.labels.append(label)
+            first = representative.setdefault(label, idx)
+            if first != idx:
+                self.moved |= 1 << idx
+                self.replacement[idx] = 1 << first
+
+    def __call__(self, sim: int) -> int:
+        """The aggregated path"""
+
+        moved = sim & self.moved
+        if not moved:
+            return sim
+
+        sim ^= moved
+        for idx in bits(moved):
+            sim |= self.replacement[idx]
+
+        return sim
+
+    def names(self, sim: int) -> List[Text]:
+        """The classes of the agents in a path"""
+
+        labels = self.labels
+        return [labels[idx] for idx in bits(sim)]
+
+    def remap(self, paths: Counter) -> Counter:
+        """Paths (bitmask -> count) as sets of classes. Paths that are
+        already aggregated are kept as they are"""
+
+        c: Counter = Counter()
+        for sim, n in paths.items():
+            c[frozenset(self.names(sim))] += n
+
+        return c
+
+    def ignored(self, ignore: Iterable[Text]) -> Set[Text]:
+        """The agents and classes of the classes with an agent in ignore"""
+
+        ignore = set(ignore)
+        labels = {
+            label
+            for agent_id, label in zip(self.agent_ids, self.labels)
+            if agent_id in ignore
+        }
+
+        return ignore.union(
+            agent_id
+            for agent_id, label in zip(self.agent_ids, self.labels)
+            if label in labels
+        ).union(labels)
+
+
+def path_aggregation(
+    graph: AgentGraph, agents: dict, strategy: Optional[Text]
+) -> PathAggregation:
+    """The aggregation of paths over graph with strategy, every agent is its
+    own class without a strategy"""
+
+    if not strategy:
+        return PathAggregation(graph, {})
+
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown aggregation strategy: {strategy}")
+
+    return PathAggregation(graph, STRATEGIES[strategy](agents))
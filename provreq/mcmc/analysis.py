@@ -0,0 +1,212 @@
+"""Count weighted analysis of the simulated paths: how much of the
+probability mass (the runs) goes through each agent, which agents occur
+together, and how much of the mass is removed by removing agents.
+
+The paths are stored as a sparse paths x agents incidence matrix (CSR)
+weighted by the number of runs of each path, so the answers are
+vectorized numpy operations. Requires numpy."""
+
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Set, Text, Tuple
+
+import numpy
+
+# Paths in each dense block of the co-occurrence computation
+CHUNK = 65536
+
+
+class Incidence:
+    """Sparse paths x agents incidence matrix. The agents of path p are
+    indices[indptr[p]:indptr[p + 1]], and weights[p] is the number of runs
+    of the path"""
+
+    def __init__(
+        self,
+        indptr: numpy.ndarray,
+        indices: numpy.ndarray,
+        weights: numpy.ndarray,
+        n_agents: int,
+    ) -> None:
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.n_agents = n_agents
+        # path of each entry in indices
+        self.rows = numpy.repeat(
+            numpy.arange(len(weights), dtype=numpy.int64), numpy.diff(indptr)
+        )
+        self.total = float(weights.sum())
+        self._mass: Optional[numpy.ndarray] = None
+
+    @classmethod
+    def from_paths(cls, paths: Counter, n_agents: int) -> "Incidence":
+        """Create the matrix of paths (agent bitmask -> runs)"""
+
+        n_words = max(1, (n_agents + 63) // 64)
+        words = numpy.frombuffer(
+            b"".join(sim.to_bytes(n_words * 8, "little") for sim in paths),
+            dtype="<u8",
+        )
+
+        # paths are sparse, so only the set bytes of the words with bits set
+        # are unpacked. Bit positions are global over all the words (path *
+        # n_words * 64 + agent), and in order
+        word_index = numpy.flatnonzero(words)
+        word_bytes = words[word_index].view(numpy.uint8)
+        byte_index = numpy.flatnonzero(word_bytes != 0)
+        bit = numpy.flatnonzero(
+            numpy.unpackbits(word_bytes[byte_index], bitorder="little").view(bool)
+        )
+        byte = byte_index[bit >> 3]
+        position = word_index[byte >> 3] * 64 + (byte & 7) * 8 + (bit & 7)
+        row, col = numpy.divmod(position, n_words * 64)
+
+        indptr = numpy.zeros(len(paths) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(row, minlength=len(paths)), out=indptr[1:])
+        indices = col.astype(numpy.int32)
+        weights = numpy.fromiter(paths.values(), dtype=numpy.float64, count=len(paths))
+
+        return cls(indptr, indices, weights, n_agents)
+
+    def mass(self) -> numpy.ndarray:
+        """Number of runs through each agent"""
+
+        if self._mass is None:
+            self._mass = numpy.bincount(
+                self.indices,
+                weights=self.weights[self.rows],
+                minlength=self.n_agents,
+            )
+
+        return self._mass
+
+    def kill_scores(self) -> numpy.ndarray:
+        """Share of the runs removed by removing each agent, the share of
+        the runs through the agent"""
+
+        return self.mass() / max(self.total, 1.0)
+
+    def choke_points(
+        self, candidates: numpy.ndarray, top: int
+    ) -> List[Tuple[int, float]]:
+        """The top agents of candidates (bool per agent) by runs through
+        them, as (agent, runs)"""
+
+        mass = numpy.where(candidates, self.mass(), -1.0)
+        order = numpy.argsort(-mass, kind="stable")[:top]
+
+        return [(int(agent), float(mass[agent])) for agent in order if mass[agent] > 0]
+
+    def cooccurrence(self, agents: Iterable[int]) -> numpy.ndarray:
+        """Runs through both agents of each pair of agents (k x k, the
+        diagonal is the runs through each agent)"""
+
+        agents = list(agents)
+        column = numpy.full(self.n_agents, -1, dtype=numpy.int64)
+        column[agents] = numpy.arange(len(agents))
+
+        res = numpy.zeros((len(agents), len(agents)))
+        selected = column[self.indices] >= 0
+        rows = self.rows[selected]
+        cols = column[self.indices[selected]]
+
+        # dense path x k blocks, so memory is bounded by CHUNK. rows are
+        # sorted, as the entries are stored path by path
+        for start in range(0, len(self.weights), CHUNK):
+            stop = min(start + CHUNK, len(self.weights))
+            first, last = numpy.searchsorted(rows, [start, stop])
+            block = numpy.zeros((stop - start, len(agents)))
+            block[rows[first:last] - start, cols[first:last]] = 1.0
+            res += (block * self.weights[start:stop, None]).T @ block
+
+        return res
+
+    def conditional(self, agents: Iterable[int]) -> numpy.ndarray:
+        """P(column agent | row agent): the share of the runs through the
+        row agent that also go through the column agent"""
+
+        both = self.cooccurrence(agents)
+        runs = numpy.diag(both)[:, None]
+
+        return numpy.divide(both, runs, out=numpy.zeros_like(both), where=runs > 0)
+
+    def greedy_cut(self, candidates: numpy.ndarray, k: int) -> List[Tuple[int, float]]:
+        """Remove the agent of candidates (bool per agent) through which
+        most of the remaining runs go, k times. Return (agent, share of all
+        runs removed so far)"""
+
+        # runs through each agent of the paths not removed yet, updated
+        # with the entries of the removed paths only
+        mass = self.mass().copy()
+        alive = numpy.ones(len(self.weights), dtype=bool)
+        res = []
+        removed = 0.0
+        for _ in range(k):
+            agent = int(numpy.argmax(numpy.where(candidates, mass, 0.0)))
+            if not candidates[agent] or mass[agent] <= 0:
+                break
+
+            paths = self.rows[self.indices == agent]
+            paths = paths[alive[paths]]
+            alive[paths] = False
+
+            starts = self.indptr[paths]
+            lengths = self.indptr[paths + 1] - starts
+            entries = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+            entries += numpy.arange(len(entries))
+            mass -= numpy.bincount(
+                self.indices[entries],
+                weights=numpy.repeat(self.weights[paths], lengths),
+                minlength=self.n_agents,
+            )
+
+            removed += float(self.weights[paths].sum())
+            res.append((agent, removed / max(self.total, 1.0)))
+
+        return res
+
+
+def candidate_agents(agent_ids: List[Text], ignore: Set[Text]) -> numpy.ndarray:
+    """The agents to analyse (bool per agent): not in ignore (the query and
+    stop agents) and not shadow agents (IDs starting with _)"""
+
+    return numpy.array(
+        [not (agent.startswith("_") or agent in ignore) for agent in agent_ids],
+        dtype=bool,
+    )
+
+
+def analyse(
+    paths: Counter, agent_ids: List[Text], ignore: Set[Text], top: int = 5
+) -> Dict[Text, Any]:
+    """The top weighted choke points, the greedy removal order and the
+    conditional co-occurrence of the top choke points of paths (agent
+    bitmask -> runs) over the agents in agent_ids"""
+
+    incidence = Incidence.from_paths(paths, len(agent_ids))
+    candidates = candidate_agents(agent_ids, ignore)
+    total = max(incidence.total, 1.0)
+
+    chokes = incidence.choke_points(candidates, top)
+    top_agents = [agent for agent, _ in chokes]
+    conditional = incidence.conditional(top_agents)
+
+    return {
+        "runs": incidence.total,
+        "choke_points": [
+            {"agent": agent_ids[agent], "runs": runs, "share": runs / total}
+            for agent, runs in chokes
+        ],
+        "removal": [
+            {"agent": agent_ids[agent], "removed": share}
+            for agent, share in incidence.greedy_cut(candidates, top)
+        ],
+        "conditional": {
+            agent_ids[agent]: {
+                agent_ids[other]: float(conditional[row, col])
+                for col, other in enumerate(top_agents)
+                if other != agent
+            }
+            for row, agent in enumerate(top_agents)
+        },
+    }
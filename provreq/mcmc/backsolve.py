@@ -2,10 +2,13 @@
 
 import argparse
 import json
-from typing import Dict, Set, Text
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Text
 
 from provreq.tools import config
 
+import provreq.mcmc.model
+
 
 def command_line_arguments() -> argparse.Namespace:
     """Parse the command line arguments"""
@@ -16,6 +19,16 @@ def command_line_arguments() -> argparse.Namespace:
         "-s", "--stats", type=str, default="stats.json", help="stats data"
     )
 
+    parser.add_argument(
+        "--model",
+        type=str,
+        help=(
+            "Compiled model file (see provreq-mcmc-compile) used in place of "
+            "parsing the stats and agent promises. It is (re)compiled when "
+            "missing or when the source files change"
+        ),
+    )
+
     parser.add_argument("--agents", type=config.split_arg, help="Agents to backsolve")
 
     args: argparse.Namespace = config.handle_args(parser, "generate")
@@ -50,29 +63,49 @@ def backsolve(
     return new_set
 
 
-def main() -> None:
-    """main entry point"""
+def backsolve_rounds(
+    stats: Dict[Text, Dict[Text, int]], agents: Dict[Text, Dict], base: Iterable[Text]
+) -> List[List[Text]]:
+    """Backsolve from base until no new agents are found, return the new
+    agents of each round"""
 
-    args = command_line_arguments()
+    base_agents = set(base)
+    new_agents: set = set(base_agents)
+    rounds = []
 
-    with open(args.stats, encoding="utf8") as file_handle:
-        stats = json.load(file_handle)
+    while True:
+        base_agents.update(new_agents)
 
-        agents, _, _ = config.read_agent_promises(args)
+        new_set = backsolve(stats, agents, base_agents)
+
+        rounds.append(sorted(new_set.difference(base_agents)))
 
-        new_agents: set = set(args.agents)
-        base_agents = set(args.agents)
+        new_agents.update(new_set)
 
-        while True:
-            base_agents.update(new_agents)
+        if not new_agents.difference(base_agents):
+            break
 
-            new_set = backsolve(stats, agents, base_agents)
+    return rounds
 
-            for agent in new_set.difference(base_agents):
-                print(f"{agent} - {agents[agent]['name']}")
 
-            new_agents.update(new_set)
+def main() -> None:
+    """main entry point"""
+
+    args = command_line_arguments()
+
+    if args.model:
+        agents, graph = provreq.mcmc.model.load_model(args, Path(args.stats))
+        stats = graph.stats()
+    else:
+        with open(args.stats, encoding="utf8") as file_handle:
+            stats = json.load(file_handle)
+
+        agents, _, _ = config.read_agent_promises(args)
+
+    rounds = backsolve_rounds(stats, agents, args.agents)
 
-            if not new_agents.difference(base_agents):
-                break
+    for idx, new_agents in enumerate(rounds):
+        if idx:
             print("---")
+        for agent in new_agents:
+            print(f"{agent} - {agents[agent]['name']}")
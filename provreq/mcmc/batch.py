@@ -0,0 +1,471 @@
+"""Run many montecarlo queries against one loaded model.
+
+Queries are read from a JSONL file, one JSON object per line:
+
+    {"id": "incident-1", "agents": ["T1486"], "seeds": [], "runs": 20000}
+
+Each query may set id, agents, seeds, seed_class, stop_agents,
+stop_agent_class, pre_seed_stop_agent_requirements, prune_unreachable,
+runs, converge, top, aggregation, raw_paths, analysis and random_seed.
+Anything not set is taken from the command line. The model is loaded once,
+and the worker processes (with their sampler tables and validation caches)
+are shared by all the queries. One JSON result per query is written to the
+output file."""
+
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Text, Tuple
+
+from provreq.tools import config
+
+import provreq.mcmc.model
+from provreq.mcmc.aggregators.online import path_aggregation
+from provreq.mcmc.convergence import ConvergenceMonitor
+from provreq.mcmc.graph import AgentGraph
+from provreq.mcmc.montecarlo import (
+    BATCH_SIZE,
+    Query,
+    Run,
+    cache_key,
+    choke_agents_mask,
+    init_pool_worker,
+    interrupted,
+    pruned_providers,
+    query_params,
+    report_agents,
+    resolve_seeds,
+    resolve_stop_agents,
+    setup_worker,
+    unsatisfiable,
+    worker_rng_states,
+)
+from provreq.mcmc.resultcache import ResultCache
+
+
+def add_query_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the model and query default arguments shared by batch and serve"""
+
+    parser.add_argument(
+        "-s", "--stats", type=str, default="stats.json", help="stats data"
+    )
+
+    parser.add_argument(
+        "--model",
+        type=str,
+        help=(
+            "Compiled model artifact (see provreq-mcmc-compile). It is "
+            "(re)compiled if missing or outdated"
+        ),
+    )
+
+    parser.add_argument(
+        "-r",
+        "--runs",
+        type=int,
+        default=100_000,
+        help="Default number of simulated passes through the chain per query",
+    )
+
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=5,
+        help="Default number of paths in each result, default: 5",
+    )
+
+    parser.add_argument(
+        "--converge",
+        type=float,
+        metavar="TOLERANCE",
+        help="Default tolerance for stopping a query early (see montecarlo)",
+    )
+
+    parser.add_argument(
+        "--aggregation",
+        type=str,
+        help="Default aggregation strategy (children|equivalence)",
+    )
+
+    parser.add_argument(
+        "--raw-paths",
+        action="store_true",
+        help=(
+            "Default for aggregating the paths at the end, not as they are "
+            "recorded (see montecarlo)"
+        ),
+    )
+
+    parser.add_argument(
+        "--analysis",
+        action="store_true",
+        help=(
+            "Default for adding the count weighted choke point analysis to "
+            "the results (see montecarlo, requires numpy)"
+        ),
+    )
+
+    parser.add_argument(
+        "--prune-unreachable",
+        action="store_true",
+        help=(
+            "Default for never drawing providers that can not be activated "
+            "from the seeds (see montecarlo)"
+        ),
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to run the simulations, default: 1",
+    )
+
+    parser.add_argument(
+        "--random-seed",
+        type=int,
+        help="Default seed of the random number generators",
+    )
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="reference",
+        choices=["reference", "numpy"],
+        help="Simulation engine (see montecarlo), default: reference",
+    )
+
+    parser.add_argument(
+        "--validation-cache-size",
+        type=int,
+        default=1_000_000,
+        help=(
+            "Max number of validated agent bundles to remember, shared by "
+            "all queries, default: 1000000"
+        ),
+    )
+
+    parser.add_argument(
+        "--result-cache",
+        type=str,
+        metavar="DIR",
+        help="Keep and reuse the results of queries with a random seed in DIR",
+    )
+
+    parser.add_argument(
+        "--result-cache-size",
+        type=int,
+        default=1024,
+        help="Max size of --result-cache in MB, default: 1024",
+    )
+
+
+def command_line_arguments() -> argparse.Namespace:
+    """Parse the command line arguments"""
+
+    parser = config.common_args("AEP Cyberhunt Requirements montecarlo batch")
+
+    add_query_arguments(parser)
+
+    parser.add_argument("-q", "--queries", type=str, help="Query specs (JSONL)")
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="results.jsonl",
+        help="Store results (JSONL), default: results.jsonl",
+    )
+
+    args: argparse.Namespace = config.handle_args(parser, "generate")
+
+    return args
+
+
+def read_queries(filename: Text) -> Iterator[Tuple[int, Text]]:
+    """Yield (line number, line) of the non-empty lines in filename, the
+    lines are parsed by parse_query"""
+
+    with open(filename, encoding="utf-8") as file_handle:
+        for line_no, line in enumerate(file_handle, 1):
+            if line.strip():
+                yield line_no, line
+
+
+def parse_query(line: Text) -> Dict[Text, Any]:
+    """Parse the query spec of a line, which must be a JSON object"""
+
+    spec = json.loads(line)
+    if not isinstance(spec, dict):
+        raise ValueError("The query must be a JSON object")
+    return spec
+
+
+def _integer(spec: Dict[Text, Any], name: Text, default: Any) -> Any:
+    """The integer spec[name], or default if not set"""
+
+    value = spec.get(name, default)
+    if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+        raise ValueError(f"{name} must be an integer")
+    return value
+
+
+def run_query(
+    spec: Dict[Text, Any],
+    args: argparse.Namespace,
+    agents: Dict,
+    graph: AgentGraph,
+    workers: int,
+    pool: Optional[Any] = None,
+    stop: Optional[Callable[[], bool]] = None,
+    cache: Optional[ResultCache] = None,
+    sources: Optional[Dict[Text, Text]] = None,
+) -> Dict[Text, Any]:
+    """Run the simulations of a query spec and return the result. The
+    simulations are stopped early on ctrl-c or when stop returns True,
+    within SLICE_SECONDS (see montecarlo) also in the middle of a batch.
+    With cache, results of earlier runs of the same query on a model made
+    from sources (name -> hash) are reused"""
+
+    start = time.monotonic()
+
+    query_agents = spec.get("agents", [])
+    if not query_agents:
+        raise ValueError("Agents can not be empty")
+    unknown = [agent for agent in query_agents if agent not in graph.agent_index]
+    if unknown:
+        raise ValueError(f"Unknown agents: {', '.join(unknown)}")
+
+    unknown = [
+        agent
+        for agent in spec.get("stop_agents") or []
+        if agent not in graph.agent_index
+    ]
+    if unknown:
+        raise ValueError(f"Unknown stop agents: {', '.join(unknown)}")
+
+    stop_agents = resolve_stop_agents(
+        agents, spec.get("stop_agents"), spec.get("stop_agent_class")
+    )
+    if not stop_agents:
+        raise ValueError("Stop agents can not be empty")
+
+    seeds = resolve_seeds(
+        agents,
+        spec.get("seeds"),
+        stop_agents,
+        spec.get("pre_seed_stop_agent_requirements", False),
+        spec.get("seed_class"),
+        verbose=False,
+    )
+
+    strategy = spec.get("aggregation", args.aggregation)
+    aggregation = path_aggregation(graph, agents, strategy)
+
+    query = Query(
+        tuple(sorted(seeds)),
+        graph.agent_mask(query_agents),
+        graph.agent_mask(stop_agents),
+        spec.get("prune_unreachable", args.prune_unreachable),
+        None if spec.get("raw_paths", args.raw_paths) else strategy or None,
+    )
+    problems = unsatisfiable(graph, query)
+    if problems:
+        raise ValueError(f"{'; '.join(problems)}, no path will validate")
+
+    n = _integer(spec, "runs", args.runs)
+    top = _integer(spec, "top", args.top)
+    converge = spec.get("converge", args.converge)
+    if converge is not None and (
+        not isinstance(converge, (int, float)) or isinstance(converge, bool)
+    ):
+        raise ValueError("converge must be a number")
+
+    random_seed = _integer(spec, "random_seed", args.random_seed)
+
+    # the paths are of the aggregated classes, unless they are raw
+    ignore = stop_agents.union(query_agents)
+    labels = graph.agent_ids
+    if query.aggregation:
+        ignore = aggregation.ignored(ignore)
+        labels = aggregation.labels
+
+    run = Run(
+        query,
+        worker_rng_states(random_seed, workers),
+        choke_mask=choke_agents_mask(graph, ignore),
+    )
+    monitor = ConvergenceMonitor(top, converge) if converge else None
+
+    key = cached = None
+    if cache and sources:
+        params = query_params(query, query_agents, stop_agents, args.engine, workers)
+        key = cache_key(cache, sources, params, n, random_seed, converge, top)
+        cached = cache.get(key) if key else None
+
+    if cached:
+        run.restore_result(graph, cached)
+
+    def stopping() -> bool:
+        return bool(interrupted) or bool(stop and stop())
+
+    stopped = False
+    while not cached and run.accepted < n:
+        run.batch(min(n - run.accepted, BATCH_SIZE * workers), pool, stopping)
+        # a stopped batch may be partial, check convergence on whole ones
+        if stopping():
+            stopped = True
+            break
+        if monitor and monitor.check(run.paths, run.chokes, run.accepted):
+            break
+
+    converged = cached["converged"] if cached else monitor and monitor.reason
+    if cache and key and not cached and not stopped:
+        cache.put(key, {**run.result(graph), "converged": converged})
+
+    chokes = run.chokes
+    paths = aggregation.remap(run.paths)
+    shown = report_agents(agents, strategy)
+
+    res: Dict[Text, Any] = {
+        "seeds": list(query.seeds),
+        "stop_agents": sorted(stop_agents),
+        "runs": run.accepted,
+        "attempts": run.attempted,
+        "converged": converged or None,
+        "interrupted": stopped,
+        "cached": bool(cached),
+        "seconds": round(time.monotonic() - start, 3),
+        "paths": len(paths),
+        "top": [
+            {
+                "agents": sorted(path),
+                "count": count,
+                "share": count / max(1, run.accepted),
+            }
+            for path, count in paths.most_common(top)
+        ],
+        "choke_points": [
+            {
+                "agent": labels[idx],
+                "name": shown[labels[idx]]["name"],
+                "count": count,
+            }
+            for idx, count in chokes.most_common(top)
+        ],
+        "missing": dict(run.missing.most_common()),
+        "pruned": sorted(pruned_providers(graph, query)),
+    }
+
+    if spec.get("analysis", args.analysis):
+        from provreq.mcmc.analysis import analyse
+
+        res["analysis"] = analyse(run.paths, labels, ignore, top)
+
+    return res
+
+
+def query_record(
+    line_no: int,
+    line: Text,
+    args: argparse.Namespace,
+    agents: Dict,
+    graph: AgentGraph,
+    workers: int,
+    pool: Optional[Any] = None,
+    cache: Optional[ResultCache] = None,
+    sources: Optional[Dict[Text, Text]] = None,
+) -> Dict[Text, Any]:
+    """The output record of the query on line line_no of the queries file,
+    the id (line_no if not set) with the result, or with the error if the
+    query is invalid"""
+
+    query_id = line_no
+    try:
+        spec = parse_query(line)
+        query_id = spec.get("id", line_no)
+        return {
+            "id": query_id,
+            **run_query(
+                spec,
+                args,
+                agents,
+                graph,
+                workers,
+                pool,
+                cache=cache,
+                sources=sources,
+            ),
+        }
+    except (KeyError, TypeError, ValueError) as err:
+        return {"id": query_id, "error": str(err)}
+
+
+def main() -> None:
+    """main entry point"""
+
+    args = command_line_arguments()
+
+    if not args.queries:
+        sys.stderr.write("missing --queries\n")
+        sys.exit(1)
+
+    agents, graph = provreq.mcmc.model.load_model(
+        args, provreq.mcmc.model.stats_file(args)
+    )
+
+    workers = max(1, args.workers)
+    worker_args = (graph, agents, args.engine, args.validation_cache_size)
+
+    cache = sources = None
+    if args.result_cache:
+        cache = ResultCache(args.result_cache, args.result_cache_size * 1024 * 1024)
+        sources = provreq.mcmc.model.source_hashes(
+            provreq.mcmc.model.source_files(args, provreq.mcmc.model.stats_file(args))
+        )
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(
+            workers, initializer=init_pool_worker, initargs=worker_args
+        )
+    else:
+        setup_worker(*worker_args)
+
+    failed = 0
+    with open(args.output, "w", encoding="utf-8") as output:
+        for line_no, line in read_queries(args.queries):
+            result = query_record(
+                line_no, line, args, agents, graph, workers, pool, cache, sources
+            )
+            query_id = result["id"]
+            if "error" in result:
+                failed += 1
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            if interrupted:
+                print(f"Interrupted, stopping after query {query_id}")
+                break
+            print(
+                f"{query_id}: "
+                + (
+                    result["error"]
+                    if "error" in result
+                    else f"{result['runs']} runs, {result['paths']} paths "
+                    f"in {result['seconds']}s"
+                )
+            )
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    sys.stderr.write("writing %s\n" % args.output)
+    if failed:
+        sys.stderr.write(f"{failed} queries failed\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""Checkpoints of a montecarlo run, so long runs can be resumed"""
+
+import gzip
+import os
+import pickle
+from typing import Any, Dict, Text
+
+# Bump when the content of the checkpoint changes
+VERSION = 3
+
+
+def save(filename: Text, state: Dict[Text, Any]) -> None:
+    """Write state as a compressed pickle, replacing filename atomically"""
+
+    tmp_filename = f"{filename}.tmp{os.getpid()}"
+    with gzip.open(tmp_filename, "wb") as file_handle:
+        pickle.dump({"version": VERSION, **state}, file_handle, protocol=4)
+    os.replace(tmp_filename, filename)
+
+
+def load(filename: Text) -> Dict[Text, Any]:
+    """Read a checkpoint written by save"""
+
+    with gzip.open(filename, "rb") as file_handle:
+        state: Dict[Text, Any] = pickle.load(file_handle)
+
+    if state.get("version") != VERSION:
+        raise ValueError(f"Unsupported checkpoint version in {filename}")
+
+    return state
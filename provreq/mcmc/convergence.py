@@ -0,0 +1,130 @@
+"""Convergence monitoring, so the montecarlo simulation can stop when the
+top paths and choke points are settled instead of after a fixed number of
+runs"""
+
+import math
+from collections import Counter
+from typing import Any, Dict, Hashable, List, Optional, Text, Tuple
+
+
+def wilson_interval(count: int, n: int, z: float = 1.96) -> Tuple[float, float]:
+    """Wilson score interval of the proportion count / n"""
+
+    if n == 0:
+        return 0.0, 1.0
+
+    p = count / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+
+    return center - half, center + half
+
+
+class ConvergenceMonitor:
+    """Decide when the ranking of the top paths and choke points has settled.
+
+    The simulation has converged when the confidence intervals of the
+    frequencies of the top paths (and the first path below them) no longer
+    overlap, or when the top path and choke point rankings are unchanged,
+    and no top path frequency moved more than tolerance relative to the
+    frequency, for patience checks in a row. In both cases the choke point
+    ranking must be the same as in the previous check.
+
+    Ranking the paths is linear in the number of distinct paths, so only
+    every every-th batch is checked."""
+
+    def __init__(
+        self,
+        top: int,
+        tolerance: float,
+        z: float = 1.96,
+        patience: int = 3,
+        min_runs: int = 1000,
+        every: int = 4,
+    ) -> None:
+        self.top = top
+        self.tolerance = tolerance
+        self.z = z
+        self.patience = patience
+        self.min_runs = min_runs
+        self.every = every
+        self.batches = 0
+        self.stable = 0
+        self.reason: Optional[str] = None
+        self._paths: List[Hashable] = []
+        self._freqs: List[float] = []
+        self._chokes: List[Hashable] = []
+
+    def state(self) -> Dict[Text, Any]:
+        """What the monitor has seen so far, for checkpoints"""
+
+        return {
+            "batches": self.batches,
+            "stable": self.stable,
+            "reason": self.reason,
+            "paths": self._paths,
+            "freqs": self._freqs,
+            "chokes": self._chokes,
+        }
+
+    def restore(self, state: Dict[Text, Any]) -> None:
+        """Continue from a state returned by state"""
+
+        self.batches = state["batches"]
+        self.stable = state["stable"]
+        self.reason = state["reason"]
+        self._paths = state["paths"]
+        self._freqs = state["freqs"]
+        self._chokes = state["chokes"]
+
+    def separated(self, ranked: List[Tuple[Hashable, int]], n: int) -> bool:
+        """True if the intervals of the ranked (path, count) do not overlap"""
+
+        intervals = [wilson_interval(count, n, self.z) for _, count in ranked]
+        return all(low > high for (low, _), (_, high) in zip(intervals, intervals[1:]))
+
+    def check(self, paths: Counter, chokes: Counter, n: int) -> bool:
+        """Check the path and choke point counts after n accepted runs, and
+        return True if the simulation has converged"""
+
+        self.batches += 1
+        if self.batches % self.every:
+            return False
+
+        ranked = paths.most_common(self.top + 1)
+        top_paths = [path for path, _ in ranked[: self.top]]
+        freqs = [count / n for _, count in ranked[: self.top]]
+        top_chokes = [agent for agent, _ in chokes.most_common(self.top)]
+
+        chokes_stable = top_chokes == self._chokes
+        if (
+            chokes_stable
+            and top_paths == self._paths
+            and max(
+                (abs(freq - prev) / prev for freq, prev in zip(freqs, self._freqs)),
+                default=0.0,
+            )
+            <= self.tolerance
+        ):
+            self.stable += 1
+        else:
+            self.stable = 0
+
+        self._paths, self._freqs, self._chokes = top_paths, freqs, top_chokes
+
+        if n < self.min_runs or not chokes_stable:
+            return False
+
+        if self.separated(ranked, n):
+            self.reason = f"top {self.top} path frequencies are separated"
+            return True
+
+        if self.stable >= self.patience:
+            self.reason = (
+                f"rankings stable within {self.tolerance:.1%} for {self.stable} "
+                "checks"
+            )
+            return True
+
+        return False
@@ -1,7 +1,12 @@
 import argparse
+import hashlib
 import json
+import multiprocessing
+import os
 import sys
 from collections import defaultdict
+from pprint import pprint
+from typing import Any, Dict, List, Optional, Set, Text, Tuple, Type
 
 from provreq.tools import config
 
@@ -41,6 +46,16 @@ def command_line_arguments() -> argparse.Namespace:
         ),
     )
 
+    parser.add_argument(
+        "--u42-validate",
+        default=False,
+        action="store_true",
+        help=(
+            "Parse the U42 playbooks as (validated) STIX bundles, "
+            "default is to only read the attack patterns from the JSON"
+        ),
+    )
+
     parser.add_argument(
         "--mitresightingsdump",
         type=str,
@@ -76,6 +91,35 @@ def command_line_arguments() -> argparse.Namespace:
         "bundle is added. Of require, only requirements is added",
     )
 
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of processes used to read and count the sources, "
+            "default: 1 (--print-defir and --debug always use one)"
+        ),
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help=(
+            "Directory to keep the counts of each source file in. Files that "
+            "are unchanged since the last run (and with the same agent "
+            "promises) are not read again"
+        ),
+    )
+
+    parser.add_argument(
+        "--download-dir",
+        type=str,
+        help=(
+            "Directory to keep downloaded sources (--u42-data URL) in, they are "
+            "only downloaded again if changed. Default: ~/.cache/provreq-mcmc"
+        ),
+    )
+
     parser.add_argument(
         "-o", "--output", type=str, default="stats.json", help="Store output"
     )
@@ -85,6 +129,191 @@ def command_line_arguments() -> argparse.Namespace:
     return args
 
 
+# (argument, name, reader) of the data sources
+SOURCES: List[Tuple[Text, Text, Type[DataReader]]] = [
+    ("defir_data", "DEFIR", DEFIRDataReader),
+    ("tie_data", "TIE", TIEDataReader),
+    ("aep_data", "AEP", AEPDataReader),
+    ("u42_data", "u42 data", U42PlaybookDataReader),
+    ("mitresightingsdump", "MITRESightings", MITRESightingsReader),
+]
+
+
+def count_bundle(
+    bundle: Dict[Text, List[Text]],
+    agents: Dict,
+    output: Dict[Text, Dict[Text, int]],
+    missing: Set[Text],
+    debug: bool = False,
+) -> None:
+    """Count the agents in the bundle providing requirements of the other
+    agents in the bundle. output is updated with requirement -> agent -> count
+    and missing with agents not found in agents"""
+
+    if debug:
+        print("bundle:", type(bundle))
+    for _, agent_list in bundle.items():
+        if debug:
+            print("Len agent_list", len(agent_list))
+        list_reqs = set()
+
+        for agent in agent_list:
+            agent = remap.get(agent, agent)
+            if not agent:
+                continue
+            if agent not in agents:
+                missing.add(agent)
+                if debug:
+                    print("DEBUG: missing", agent)
+                continue
+            for req in agents[agent]["requires"]:
+                if debug:
+                    print("Adding list_reqs", agent, req)
+                list_reqs.add(req)
+
+        if debug:
+            print("len list_reqs", len(list_reqs))
+            print("len agent_list", len(agent_list))
+
+        for pos_agent in agent_list:
+            pos_agent = remap.get(pos_agent, pos_agent)
+            if not pos_agent:
+                if debug:
+                    print("Continue due to pos_agent", pos_agent)
+                continue
+            if pos_agent not in agents:
+                missing.add(pos_agent)
+                if debug:
+                    print("Continue due missing pos_agent", pos_agent)
+                continue
+            for req in list_reqs:
+                if req in agents[pos_agent]["provides"]:
+                    if req not in output:
+                        output[req] = defaultdict(int)
+                    if debug:
+                        print("Adding output for req, pos_agent", req, pos_agent)
+                    output[req][pos_agent] += 1
+
+
+# Bump when count_bundle changes, to invalidate cached counts
+CACHE_VERSION = 1
+
+# Agents and options used by count_part, set by setup_worker
+_worker: Dict[Text, Any] = {}
+
+
+def agents_version(agents: Dict) -> Text:
+    """Hash of everything in the agent promises (and the remapping of agent
+    IDs) the counts depend on"""
+
+    data = {
+        agent_id: [sorted(agent["requires"]), sorted(agent["provides"])]
+        for agent_id, agent in agents.items()
+    }
+
+    return hashlib.sha256(
+        json.dumps([CACHE_VERSION, data, remap], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def create_readers(args: argparse.Namespace) -> List[DataReader]:
+    """Create the reader of each of the SOURCES"""
+
+    return [
+        (
+            U42PlaybookDataReader(args.download_dir, args.u42_validate)
+            if reader_class is U42PlaybookDataReader
+            else reader_class()
+        )
+        for _, _, reader_class in SOURCES
+    ]
+
+
+def setup_worker(
+    agents: Dict,
+    readers: List[DataReader],
+    focus: Text,
+    debug: bool,
+    print_defir: bool,
+    cache_dir: Optional[Text] = None,
+) -> None:
+    """Set the agents, readers and options used by count_part in this process"""
+
+    _worker.update(
+        agents=agents,
+        readers=readers,
+        focus=focus,
+        debug=debug,
+        print_defir=print_defir,
+        cache_dir=cache_dir,
+        version=agents_version(agents) if cache_dir else None,
+    )
+
+
+def _cache_file(source: int, part: Any) -> Optional[Text]:
+    """Filename of the cached counts of a part, None if it can not be cached"""
+
+    if not _worker["cache_dir"] or _worker["print_defir"]:
+        return None
+
+    name = SOURCES[source][1]
+    digest = _worker["readers"][source].part_digest(part)
+    if digest is None:
+        return None
+
+    key = hashlib.sha256(
+        json.dumps([name, digest, _worker["focus"], _worker["version"]]).encode("utf-8")
+    ).hexdigest()
+
+    return os.path.join(_worker["cache_dir"], f"{key}.json")
+
+
+def count_part(
+    task: Tuple[int, Any],
+) -> Tuple[int, int, Dict[Text, Dict[Text, int]], Set[Text], bool]:
+    """Read and count one part of a source (index into SOURCES), or reuse the
+    cached counts of the part. Return the source index, the number of
+    bundles, the partial counts, the missing agents and if the counts were
+    cached"""
+
+    source, part = task
+
+    cache_file = _cache_file(source, part)
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, encoding="utf-8") as file_handle:
+            cached = json.load(file_handle)
+        return source, cached["n"], cached["output"], set(cached["missing"]), True
+
+    output: Dict[Text, Dict[Text, int]] = {}
+    missing: Set[Text] = set()
+    n = 0
+    for bundle in _worker["readers"][source].iterate_part(part):
+        n += 1
+        if _worker["print_defir"]:
+            pprint(bundle)
+        if _worker["focus"] == "require":
+            count_bundle(bundle, _worker["agents"], output, missing, _worker["debug"])
+
+    if cache_file:
+        tmp_file = f"{cache_file}.tmp{os.getpid()}"
+        with open(tmp_file, "w", encoding="utf-8") as file_handle:
+            json.dump(
+                {"n": n, "output": output, "missing": sorted(missing)}, file_handle
+            )
+        os.replace(tmp_file, cache_file)
+
+    return source, n, output, missing, False
+
+
+def _cached_msg(parts: int, cached_parts: int) -> Text:
+    """Describe how many parts of a source were cached"""
+
+    if not cached_parts:
+        return ""
+
+    return f" ({cached_parts} of {parts} parts from cache)"
+
+
 def main() -> None:
     """main entry point"""
 
@@ -94,37 +323,9 @@ def main() -> None:
         sys.stderr.write("missing provreq-, u42- and/or defir- data\n")
         sys.exit(1)
 
-    data: list = []
-    if args.defir_data:
-        print("Reading DEFIR")
-        reader: DataReader = DEFIRDataReader()
-        n = len(data)
-        data += reader.read(args.defir_data)
-        print(len(data) - n, "new entries")
-    if args.tie_data:
-        print("Reading TIE")
-        reader = TIEDataReader()
-        n = len(data)
-        data += reader.read(args.tie_data)
-        print(len(data) - n, "new entries")
-    if args.aep_data:
-        print("Reading AEP")
-        reader = AEPDataReader()
-        n = len(data)
-        data += reader.read(args.aep_data)
-        print(len(data) - n, "new entries")
-    if args.u42_data:
-        print("Reading u42 data")
-        reader = U42PlaybookDataReader()
-        n = len(data)
-        data += reader.read(args.u42_data)
-        print(len(data) - n, "new entries")
-    if args.mitresightingsdump:
-        print("Reading MITRESightings")
-        reader = MITRESightingsReader()
-        n = len(data)
-        data += reader.read(args.mitresightingsdump)
-        print(len(data) - n, "new entries")
+    if args.focus not in ["require", "provide"]:
+        print("Focus must be either require or provide")
+        sys.exit(1)
 
     if args.debug:
         print("read agent promises", args.data_dir, args.agent_promises)
@@ -134,72 +335,73 @@ def main() -> None:
     if args.debug:
         print("done reading agent promises")
 
-    if args.focus not in ["require", "provide"]:
-        print("Focus must be either require or provide")
-        sys.exit(1)
-
     output: dict = {}
-    # reqset: set = set()
-    missing = set()
-    if args.focus == "require":
-        for bundle in data:
-            # print(bundle)
-            if args.debug:
-                print("bundle:", type(bundle))
-            for _, agent_list in bundle.items():
-                if args.debug:
-                    print("Len agent_list", len(agent_list))
-                list_reqs = set()
-
-                for agent in agent_list:
-                    agent = remap.get(agent, agent)
-                    if not agent:
-                        continue
-                    if agent not in agents:
-                        missing.add(agent)
-                        if args.debug:
-                            print("DEBUG: missing", agent)
-                        continue
-                    for req in agents[agent]["requires"]:
-                        if args.debug:
-                            print("Adding list_reqs", agent, req)
-                        list_reqs.add(req)
-
-                if args.debug:
-                    print("len list_reqs", len(list_reqs))
-                    print("len agent_list", len(agent_list))
-
-                for pos_agent in agent_list:
-                    pos_agent = remap.get(pos_agent, pos_agent)
-                    if not pos_agent:
-                        if args.debug:
-                            print("Continue due to pos_agent", pos_agent)
-                        continue
-                    if pos_agent not in agents:
-                        missing.add(pos_agent)
-                        if args.debug:
-                            print("Continue due missing pos_agent", pos_agent)
-                        continue
-                    for req in list_reqs:
-                        if req in agents[pos_agent]["provides"]:
-                            if req not in output:
-                                output[req] = defaultdict(int)
-                            if args.debug:
-                                print(
-                                    "Adding output for req, pos_agent", req, pos_agent
-                                )
-                            output[req][pos_agent] += 1
-
-        if args.print_defir:
-            from pprint import pprint
-
-            pprint(data)
-            for req in output:
-                print(f"requirement: {req} provided by:")
-                for agent, count in output[req].items():
-                    print(f"\t{agent}: [{agents[agent]['name']}] : {count} times")
-                print("--")
-            sys.exit()
+    missing: Set[Text] = set()
+
+    readers = create_readers(args)
+
+    tasks = []
+    for source, (arg, _, _) in enumerate(SOURCES):
+        filename = getattr(args, arg)
+        if filename:
+            tasks += [(source, part) for part in readers[source].parts(filename)]
+
+    if args.cache_dir:
+        os.makedirs(args.cache_dir, exist_ok=True)
+
+    worker_args = (
+        agents,
+        readers,
+        args.focus,
+        args.debug,
+        args.print_defir,
+        args.cache_dir,
+    )
+
+    pool = None
+    if args.workers > 1 and not (args.print_defir or args.debug):
+        pool = multiprocessing.Pool(
+            args.workers, initializer=setup_worker, initargs=worker_args
+        )
+        results = pool.imap(count_part, tasks, chunksize=4)
+    else:
+        setup_worker(*worker_args)
+        results = map(count_part, tasks)
+
+    # Each bundle is counted as it is read and the partial counts are merged
+    # in the order of the sources, so only the counts are kept in memory
+    current = None
+    n = parts = cached_parts = 0
+    for source, part_n, part_output, part_missing, cached in results:
+        if source != current:
+            if current is not None:
+                print(f"{n} new entries{_cached_msg(parts, cached_parts)}")
+            print(f"Reading {SOURCES[source][1]}")
+            current = source
+            n = parts = cached_parts = 0
+        n += part_n
+        parts += 1
+        cached_parts += cached
+        missing.update(part_missing)
+        for req, counts in part_output.items():
+            if req not in output:
+                output[req] = defaultdict(int)
+            for agent, count in counts.items():
+                output[req][agent] += count
+    if current is not None:
+        print(f"{n} new entries{_cached_msg(parts, cached_parts)}")
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if args.focus == "require" and args.print_defir:
+        for req in output:
+            print(f"requirement: {req} provided by:")
+            for agent, count in output[req].items():
+                print(f"\t{agent}: [{agents[agent]['name']}] : {count} times")
+            print("--")
+        sys.exit()
 
     with open(args.output, "w", encoding="utf-8") as f:
         sys.stderr.write("writing %s\n" % args.output)
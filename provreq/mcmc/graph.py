@@ -0,0 +1,201 @@
+"""Compiled representation of the agents and the stats used by the montecarlo
+simulation. Agents and promises are interned to dense integers, and the
+requires/provides of each agent are stored as integer bitmasks over the
+promise indexes, so set operations in the simulation become bitwise
+operations on python ints."""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Text, Tuple
+
+from provreq.mcmc.sampler import WeightedSampler
+
+
+def bits(mask: int) -> Iterator[int]:
+    """Iterate over the indexes of the bits set in mask, lowest first"""
+
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class AgentGraph:
+    """Agents and promises interned to integers with bitmask requires/provides.
+
+    samplers[promise] draws the index of an agent providing the promise, or
+    None if the promise is never seen in the stats. Providers in the stats
+    that are not in agents are encoded as negative numbers (~n is the index
+    into unknown)."""
+
+    def __init__(
+        self,
+        agent_ids: List[Text],
+        promise_ids: List[Text],
+        requires: List[int],
+        provides: List[int],
+        samplers: List[Optional[WeightedSampler]],
+        unknown: List[Text],
+    ) -> None:
+        self.agent_ids = agent_ids
+        self.promise_ids = promise_ids
+        self.agent_index = {agent: idx for idx, agent in enumerate(agent_ids)}
+        self.promise_index = {prom: idx for idx, prom in enumerate(promise_ids)}
+        self.requires = requires
+        self.provides = provides
+        self.samplers = samplers
+        self.unknown = unknown
+
+    @classmethod
+    def compile(
+        cls, agents: Dict[Text, Dict], stats: Dict[Text, Dict[Text, int]]
+    ) -> "AgentGraph":
+        """Compile agents and stats (promise -> agent -> count)"""
+
+        agent_ids = list(agents)
+        agent_index = {agent: idx for idx, agent in enumerate(agent_ids)}
+
+        promise_index: Dict[Text, int] = {}
+        for data in agents.values():
+            for prom in data["requires"] + data["provides"]:
+                promise_index.setdefault(prom, len(promise_index))
+        for prom in stats:
+            promise_index.setdefault(prom, len(promise_index))
+
+        def _mask(promises: Iterable[Text]) -> int:
+            mask = 0
+            for prom in promises:
+                mask |= 1 << promise_index[prom]
+            return mask
+
+        requires = [_mask(agents[agent]["requires"]) for agent in agent_ids]
+        provides = [_mask(agents[agent]["provides"]) for agent in agent_ids]
+
+        unknown: List[Text] = []
+        unknown_index: Dict[Text, int] = {}
+        samplers: List[Optional[WeightedSampler]] = [None] * len(promise_index)
+        for prom, st in stats.items():
+            counts = {}
+            for agent, count in st.items():
+                if agent in agent_index:
+                    idx = agent_index[agent]
+                else:
+                    if agent not in unknown_index:
+                        unknown_index[agent] = len(unknown)
+                        unknown.append(agent)
+                    idx = ~unknown_index[agent]
+                counts[idx] = count
+            sampler = WeightedSampler.from_counts(counts)
+            if sampler:
+                samplers[promise_index[prom]] = sampler
+
+        return cls(
+            agent_ids, list(promise_index), requires, provides, samplers, unknown
+        )
+
+    def stats(self) -> Dict[Text, Dict[Text, int]]:
+        """The stats (promise -> agent -> count) the samplers are created from"""
+
+        res = {}
+        for prom, sampler in zip(self.promise_ids, self.samplers):
+            if sampler is None:
+                continue
+            res[prom] = {
+                self.agent_ids[agent] if agent >= 0 else self.unknown[~agent]: count
+                for agent, count in sampler.counts().items()
+            }
+
+        return res
+
+    def reachable(self, seeds: int) -> int:
+        """Bitmask of the agents that can be activated from the seed promises,
+        the forward fixpoint of activating agents whose requires are all
+        provided. Agents outside it can never be part of a valid path"""
+
+        provided = seeds
+        active = 0
+        changed = True
+        while changed:
+            changed = False
+            for idx, requires in enumerate(self.requires):
+                if not active >> idx & 1 and not requires & ~provided:
+                    active |= 1 << idx
+                    provided |= self.provides[idx]
+                    changed = True
+
+        return active
+
+    def prune(
+        self, keep: Optional[int] = None
+    ) -> Tuple["AgentGraph", Dict[Text, List[Text]]]:
+        """Return a graph without the unknown providers in the samplers, and
+        without the providers not in keep (agent bitmask) if given, and the
+        removed providers (provider -> promises it was removed from).
+
+        Dropping unknown providers does not change the draws, as they are
+        re-drawn anyway. Dropping other providers renormalizes the draws of
+        the remaining ones."""
+
+        removed: Dict[Text, List[Text]] = {}
+        samplers: List[Optional[WeightedSampler]] = []
+        for prom, sampler in zip(self.promise_ids, self.samplers):
+            if sampler is None:
+                samplers.append(None)
+                continue
+
+            drop = {
+                agent
+                for agent in sampler.items
+                if agent < 0 or (keep is not None and not keep >> agent & 1)
+            }
+            if not drop:
+                samplers.append(sampler)
+                continue
+
+            for agent in sorted(drop, reverse=True):
+                name = self.agent_ids[agent] if agent >= 0 else self.unknown[~agent]
+                removed.setdefault(name, []).append(prom)
+
+            counts = {
+                agent: count
+                for agent, count in sampler.counts().items()
+                if agent not in drop
+            }
+            samplers.append(WeightedSampler.from_counts(counts) or None)
+
+        graph = AgentGraph(
+            self.agent_ids,
+            self.promise_ids,
+            self.requires,
+            self.provides,
+            samplers,
+            self.unknown,
+        )
+
+        return graph, removed
+
+    def agent_mask(self, agents: Iterable[Text]) -> int:
+        """Bitmask of agents, agents not in the graph are ignored"""
+
+        mask = 0
+        for agent in agents:
+            if agent in self.agent_index:
+                mask |= 1 << self.agent_index[agent]
+        return mask
+
+    def promise_mask(self, promises: Iterable[Text]) -> int:
+        """Bitmask of promises, promises not in the graph are ignored"""
+
+        mask = 0
+        for prom in promises:
+            if prom in self.promise_index:
+                mask |= 1 << self.promise_index[prom]
+        return mask
+
+    def agent_names(self, mask: int) -> List[Text]:
+        """Agent IDs of the agents in a bitmask"""
+
+        return [self.agent_ids[idx] for idx in bits(mask)]
+
+    def promise_names(self, mask: int) -> List[Text]:
+        """Promise IDs of the promises in a bitmask"""
+
+        return [self.promise_ids[idx] for idx in bits(mask)]
@@ -0,0 +1,326 @@
+"""Compiled model artifact with the agents, the interned graph and the
+sampler tables, so the montecarlo and backsolve tools can skip parsing
+stats.json and the agent promises on every run.
+
+The artifact is a single binary file:
+
+    magic (8 bytes) | version (u32) | header length (u32) | header (JSON)
+    | sections, each aligned to 8 bytes
+
+The header holds the interned agent and promise IDs, the hashes of the
+source files and the offset/length of each section. The sampler tables
+are native int64 arrays that are used directly from a read-only memory
+map, so loading is near-instant and the tables are shared between
+processes through the page cache."""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Text, Tuple
+
+from provreq.tools import config
+
+from provreq.mcmc.graph import AgentGraph
+from provreq.mcmc.reader.datareader import file_digest
+from provreq.mcmc.sampler import WeightedSampler
+
+MAGIC = b"PRQMCMC\x00"
+
+# Bump when the layout of the artifact changes, older artifacts are then
+# treated as outdated and recompiled
+VERSION = 1
+
+_PREAMBLE = struct.Struct("<8sII")
+
+
+def command_line_arguments() -> argparse.Namespace:
+    """Parse the command line arguments"""
+
+    parser = config.common_args("AEP Cyberhunt Requirements model compiler")
+
+    parser.add_argument(
+        "-s", "--stats", type=str, default="stats.json", help="stats data"
+    )
+
+    parser.add_argument(
+        "-o", "--output", type=str, default="model.bin", help="Store output"
+    )
+
+    args: argparse.Namespace = config.handle_args(parser, "generate")
+
+    return args
+
+
+def stats_file(args: argparse.Namespace) -> Path:
+    """Path of the stats file, relative to the data directory unless absolute"""
+
+    return Path(args.data_dir) / args.stats
+
+
+def source_files(args: argparse.Namespace, stats: Path) -> Dict[Text, Path]:
+    """The files a model is compiled from"""
+
+    return {
+        "stats": stats,
+        "agent_promises": Path(args.data_dir) / args.agent_promises,
+        "promise_descriptions": Path(args.data_dir) / args.promise_descriptions,
+        "conditions": Path(args.data_dir) / args.conditions,
+    }
+
+
+def source_hashes(sources: Dict[Text, Path]) -> Dict[Text, Text]:
+    """sha256 of each of the source files"""
+
+    return {name: file_digest(filename) for name, filename in sources.items()}
+
+
+def compile_model(
+    args: argparse.Namespace, stats: Path
+) -> Tuple[Dict[Text, Dict], AgentGraph]:
+    """Read the agents and the stats and compile the graph"""
+
+    with open(stats, encoding="utf8") as file_handle:
+        stats_data = json.load(file_handle)
+
+    agents, _, _ = config.read_agent_promises(args)
+
+    return agents, AgentGraph.compile(agents, stats_data)
+
+
+def save(
+    filename: Text,
+    agents: Dict[Text, Dict],
+    graph: AgentGraph,
+    sources: Dict[Text, Text],
+) -> None:
+    """Write the model artifact, replacing filename atomically"""
+
+    mask_bytes = max(1, (len(graph.promise_ids) + 7) // 8)
+
+    items = array("q")
+    cumulative = array("q")
+    offsets = array("q", [0])
+    for sampler in graph.samplers:
+        if sampler is not None:
+            items.extend(sampler.items)
+            cumulative.extend(sampler.cumulative)
+        offsets.append(len(items))
+
+    blobs = {
+        "agents": json.dumps(agents).encode("utf-8"),
+        "requires": b"".join(
+            mask.to_bytes(mask_bytes, "little") for mask in graph.requires
+        ),
+        "provides": b"".join(
+            mask.to_bytes(mask_bytes, "little") for mask in graph.provides
+        ),
+        "sampler_items": items.tobytes(),
+        "sampler_cumulative": cumulative.tobytes(),
+        "sampler_offsets": offsets.tobytes(),
+    }
+
+    header: Dict[Text, Any] = {
+        "byteorder": sys.byteorder,
+        "sources": sources,
+        "agent_ids": graph.agent_ids,
+        "promise_ids": graph.promise_ids,
+        "unknown": graph.unknown,
+        "mask_bytes": mask_bytes,
+    }
+
+    # The section offsets depend on the header length, so reserve room for
+    # them before encoding the header with the real offsets
+    sections = {name: [0, len(blob)] for name, blob in blobs.items()}
+    header["sections"] = sections
+    start = _align(_PREAMBLE.size + len(json.dumps(header)) + 32 * len(blobs))
+
+    offset = start
+    for name, blob in blobs.items():
+        sections[name][0] = offset
+        offset = _align(offset + len(blob))
+
+    header_data = json.dumps(header).encode("utf-8")
+    if _PREAMBLE.size + len(header_data) > start:
+        raise ValueError(
+            f"Model header of {len(header_data)} bytes does not fit in the "
+            f"{start - _PREAMBLE.size} bytes reserved for it"
+        )
+
+    tmp_filename = f"{filename}.tmp{os.getpid()}"
+    with open(tmp_filename, "wb") as file_handle:
+        file_handle.write(_PREAMBLE.pack(MAGIC, VERSION, len(header_data)))
+        file_handle.write(header_data)
+        for name, blob in blobs.items():
+            file_handle.write(b"\0" * (sections[name][0] - file_handle.tell()))
+            file_handle.write(blob)
+
+    os.replace(tmp_filename, filename)
+
+
+def _align(offset: int) -> int:
+    """Round offset up to a multiple of 8"""
+
+    return (offset + 7) & ~7
+
+
+class MappedAgentGraph(AgentGraph):
+    """AgentGraph with the sampler tables in a memory mapped model artifact.
+    It is pickled as the filename, so other processes map the same file"""
+
+    filename: Text = ""
+
+    def __reduce__(self) -> Tuple[Any, Tuple[Text]]:
+        return (load_graph, (self.filename,))
+
+
+def _read(filename: Text) -> Optional[Tuple[Dict[Text, Any], memoryview]]:
+    """Map the artifact and return its header and content, or None if it is
+    not a model artifact of this version and byte order"""
+
+    with open(filename, "rb") as file_handle:
+        try:
+            content = memoryview(
+                mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+        except ValueError:  # empty file
+            return None
+
+    if len(content) < _PREAMBLE.size:
+        return None
+
+    magic, version, length = _PREAMBLE.unpack_from(content)
+    if magic != MAGIC or version != VERSION:
+        return None
+
+    header = json.loads(bytes(content[_PREAMBLE.size : _PREAMBLE.size + length]))
+    if header["byteorder"] != sys.byteorder:
+        return None
+
+    return header, content
+
+
+def _section(header: Dict[Text, Any], content: memoryview, name: Text) -> memoryview:
+    """Return the content of a section"""
+
+    offset, length = header["sections"][name]
+    return content[offset : offset + length]
+
+
+def _graph(filename: Text, header: Dict[Text, Any], content: memoryview) -> AgentGraph:
+    """Create the graph from a mapped artifact"""
+
+    mask_bytes = header["mask_bytes"]
+
+    def _masks(name: Text) -> List[int]:
+        data = _section(header, content, name)
+        return [
+            int.from_bytes(data[pos : pos + mask_bytes], "little")
+            for pos in range(0, len(data), mask_bytes)
+        ]
+
+    items = _section(header, content, "sampler_items").cast("q")
+    cumulative = _section(header, content, "sampler_cumulative").cast("q")
+    offsets = _section(header, content, "sampler_offsets").cast("q")
+
+    samplers: List[Optional[WeightedSampler]] = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        samplers.append(
+            WeightedSampler(items[start:end], cumulative[start:end])
+            if end > start
+            else None
+        )
+
+    graph = MappedAgentGraph(
+        header["agent_ids"],
+        header["promise_ids"],
+        _masks("requires"),
+        _masks("provides"),
+        samplers,
+        header["unknown"],
+    )
+    graph.filename = filename
+
+    return graph
+
+
+def load(
+    filename: Text, sources: Optional[Dict[Text, Text]] = None
+) -> Optional[Tuple[Dict[Text, Dict], AgentGraph]]:
+    """Load the agents and the graph from a model artifact. Return None if
+    the file is not a valid artifact, or if sources is given and the hashes
+    of the sources it was compiled from differ"""
+
+    artifact = _read(filename)
+    if artifact is None:
+        return None
+
+    header, content = artifact
+    if sources is not None and header["sources"] != sources:
+        return None
+
+    agents = json.loads(bytes(_section(header, content, "agents")))
+
+    return agents, _graph(filename, header, content)
+
+
+def load_graph(filename: Text) -> AgentGraph:
+    """Load only the graph from a model artifact"""
+
+    artifact = _read(filename)
+    if artifact is None:
+        raise ValueError(f"Not a valid model artifact: {filename}")
+
+    return _graph(filename, *artifact)
+
+
+def load_model(
+    args: argparse.Namespace, stats: Path
+) -> Tuple[Dict[Text, Dict], AgentGraph]:
+    """Return the agents and the graph. With args.model, the model artifact is
+    used if it was compiled from the current sources, otherwise it is
+    (re)compiled and saved first"""
+
+    if not args.model:
+        return compile_model(args, stats)
+
+    sources = source_hashes(source_files(args, stats))
+
+    if os.path.exists(args.model):
+        model = load(args.model, sources)
+        if model is not None:
+            return model
+        print(f"Model {args.model} is outdated, recompiling")
+    else:
+        print(f"Compiling model {args.model}")
+
+    agents, graph = compile_model(args, stats)
+    save(args.model, agents, graph, sources)
+
+    # return the mapped model, so it is shared with worker processes
+    model = load(args.model)
+    if model is None:
+        raise ValueError(f"Unable to read compiled model {args.model}")
+    return model
+
+
+def main() -> None:
+    """main entry point"""
+
+    args = command_line_arguments()
+
+    stats = stats_file(args)
+    sources = source_hashes(source_files(args, stats))
+
+    agents, graph = compile_model(args, stats)
+    save(args.output, agents, graph, sources)
+
+    sys.stderr.write("writing %s\n" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,30 +4,67 @@ import argparse
 import datetime
 import json
 import logging
-import os
+import multiprocessing
 import random
 import signal
 import sys
+import time
 import types
 from collections import Counter
-from typing import Any, Dict, List, Optional, Set, Text
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Text,
+    Tuple,
+)
 
 import tabulate
 from provreq.tools import config
 from provreq.tools.libs.libgenerate import simulate, stages_table
 
-import provreq.mcmc.aggregators.children
 import provreq.mcmc.aggregators.equivalence
+import provreq.mcmc.checkpoint
+import provreq.mcmc.model
+import provreq.mcmc.profiling
+from provreq.mcmc.aggregators.online import path_aggregation
+from provreq.mcmc.convergence import ConvergenceMonitor
+from provreq.mcmc.graph import AgentGraph, bits
 from provreq.mcmc.pbar import ProgressBar
+from provreq.mcmc.profiling import Profile
+from provreq.mcmc.resultcache import ResultCache
+from provreq.mcmc.sketch import HeavyHitters
+from provreq.mcmc.validationcache import ValidationCache
+
+# Number of accepted runs each worker does between merges of the results
+BATCH_SIZE = 1000
+
+# Seconds workers simulate before returning, when a batch can be stopped
+SLICE_SECONDS = 1.0
 
 missing_counter: Counter = Counter()
 
+# Model and query used by the simulation workers, set by setup_worker
+_worker: Dict[Text, Any] = {}
+
+
+# Signals received, main stops after the current batch when set
+interrupted: List[int] = []
+
 
 def sigint_handler(sig: int, frame: Optional[types.FrameType]) -> Any:
-    """show errors on ctrl-c"""
+    """Stop after the current batch on ctrl-c/SIGTERM, a second signal
+    shows errors and exits at once"""
 
-    if frame:
-        print(frame)
+    if not interrupted:
+        interrupted.append(sig)
+        print(f"\nSignal {sig}, stopping after the current batch (repeat to abort)")
+        return
 
     print(
         "Simulation ended due to signal",
@@ -41,10 +78,15 @@ def sigint_handler(sig: int, frame: Optional[types.FrameType]) -> Any:
             missing_counter.items(), headers=["promise", "count"], tablefmt="fancy_grid"
         )
     )
+
+    # the pool workers ignore SIGTERM
+    for child in multiprocessing.active_children():
+        child.kill()
     sys.exit(0)
 
 
 signal.signal(signal.SIGINT, sigint_handler)
+signal.signal(signal.SIGTERM, sigint_handler)
 
 
 def command_line_arguments() -> argparse.Namespace:
@@ -56,6 +98,16 @@ def command_line_arguments() -> argparse.Namespace:
         "-s", "--stats", type=str, default="stats.json", help="stats data"
     )
 
+    parser.add_argument(
+        "--model",
+        type=str,
+        help=(
+            "Compiled model file (see provreq-mcmc-compile) used in place of "
+            "parsing the stats and agent promises. It is (re)compiled when "
+            "missing or when the source files change"
+        ),
+    )
+
     parser.add_argument("--seeds", type=config.split_arg, help="Seeds of promises")
 
     parser.add_argument(
@@ -77,7 +129,20 @@ def command_line_arguments() -> argparse.Namespace:
         "--aggregation",
         type=str,
         default="",
-        help="Aggregate final simulation based [children, equivalence]",
+        help=(
+            "Aggregate the paths [children, equivalence], as they are recorded "
+            "unless --raw-paths is given"
+        ),
+    )
+
+    parser.add_argument(
+        "--raw-paths",
+        action="store_true",
+        help=(
+            "Keep the paths of the agents themselves and aggregate them at the "
+            "end, so the choke points and the analysis are of the agents, not "
+            "of the aggregated classes (uses memory for every distinct path)"
+        ),
     )
 
     parser.add_argument(
@@ -85,7 +150,22 @@ def command_line_arguments() -> argparse.Namespace:
         "--runs",
         type=int,
         default=100_000,
-        help="Number of simulated passes through the chain",
+        help=(
+            "Number of simulated passes through the chain "
+            "(the maximum with --converge)"
+        ),
+    )
+
+    parser.add_argument(
+        "--converge",
+        type=float,
+        metavar="TOLERANCE",
+        help=(
+            "Stop before --runs when the top --top paths and choke points "
+            "have converged: their frequencies are separated, or the rankings "
+            "are stable and the frequencies change less than TOLERANCE of "
+            "their value (e.g. 0.01) between checks"
+        ),
     )
 
     parser.add_argument(
@@ -123,113 +203,229 @@ def command_line_arguments() -> argparse.Namespace:
         help=("Populate seed agent list with all agents of one (or more) classes"),
     )
 
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to run the simulations, default: 1",
+    )
+
+    parser.add_argument(
+        "--random-seed",
+        type=int,
+        help=(
+            "Seed of the random number generators. Results are reproducible "
+            "for the same seed and number of workers"
+        ),
+    )
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="reference",
+        choices=["reference", "numpy"],
+        help=(
+            "Simulation engine. numpy advances batches of chains in lockstep "
+            "and requires numpy, default: reference"
+        ),
+    )
+
+    parser.add_argument(
+        "--validation-cache-size",
+        type=int,
+        default=1_000_000,
+        help=(
+            "Max number of validated (accepted and rejected) agent bundles "
+            "to remember, default: 1000000"
+        ),
+    )
+
+    parser.add_argument(
+        "--prune-unreachable",
+        action="store_true",
+        help=(
+            "Never draw providers that can not be activated from the seeds. "
+            "Chains through them are always rejected, so this saves attempts, "
+            "but the draws of the remaining providers are renormalized"
+        ),
+    )
+
+    parser.add_argument(
+        "--analysis",
+        action="store_true",
+        help=(
+            "Show choke points weighted by the runs of each path, the order "
+            "of removing agents that removes the most runs and the "
+            "co-occurrence of the top choke points (requires numpy)"
+        ),
+    )
+
+    parser.add_argument(
+        "--approximate",
+        type=int,
+        metavar="CAPACITY",
+        help=(
+            "Keep only the CAPACITY most frequent paths (and a count-min "
+            "sketch of all of them), so memory does not grow with --runs. The "
+            "path counts are shown with bounds and the choke points are the "
+            "runs through each agent. Not with --raw-paths or --result-cache"
+        ),
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="FILE",
+        help=(
+            "Time the phases of the run and count what happens to the "
+            "chains, print the profile and write it to FILE (JSON)"
+        ),
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help=(
+            "Write the state of the run to this file periodically, on "
+            "ctrl-c/SIGTERM and when done"
+        ),
+    )
+
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=300,
+        help="Seconds between checkpoints, default: 300",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Continue the run in --checkpoint (same query, model and "
+            "number of workers) until --runs"
+        ),
+    )
+
+    parser.add_argument(
+        "--result-cache",
+        type=str,
+        metavar="DIR",
+        help=(
+            "Keep the results of queries with --random-seed in DIR, and reuse "
+            "them for the same query on the same model files"
+        ),
+    )
+
+    parser.add_argument(
+        "--result-cache-size",
+        type=int,
+        default=1024,
+        help=(
+            "Max size of --result-cache in MB, the least recently used "
+            "results are removed, default: 1024"
+        ),
+    )
+
     args: argparse.Namespace = config.handle_args(parser, "generate")
 
     return args
 
 
 def sample_agent(
-    agent: Text,
-    agents: Dict[Text, Dict],
-    expanded_stats: Dict[Text, List[Text]],
-    allready_provided: Optional[set] = None,
-) -> List[Text]:
+    agent: int, graph: AgentGraph, allready_provided: int = 0, rng: Any = random
+) -> List[int]:
     """Select agents that provides all requires of the agent based on probability"""
 
-    to_fullfill = set(agents[agent]["requires"])
-    if allready_provided:
-        to_fullfill -= allready_provided
+    to_fullfill = graph.requires[agent] & ~allready_provided
+    samplers = graph.samplers
+    provides = graph.provides
 
     res = []
     while to_fullfill:
-        prom = to_fullfill.pop()
-        if prom not in expanded_stats:
+        prom = to_fullfill & -to_fullfill
+        sampler = samplers[prom.bit_length() - 1]
+        if sampler is None:
             # logging.warning("Promises never seen in stats %s", prom)
             return []
-        randagent = random.choice(expanded_stats[prom])
-        if randagent not in agents:
+        randagent = sampler.sample(rng)
+        if randagent < 0:
             logging.warning(
                 "Non existing agent '%s' sampled for '%s' ignore and re-draw",
-                randagent,
-                agent,
+                graph.unknown[~randagent],
+                graph.agent_ids[agent],
             )
-            to_fullfill.add(prom)
             continue
         res.append(randagent)
-        for prov in agents[randagent]["provides"]:
-            to_fullfill.discard(prov)
-
-    return res
-
-
-def expand_stats_list(stats: Dict[Text, Dict[Text, int]]) -> Dict[Text, List[Text]]:
-    """Take the stats list and create lists of agents in the ratio of the stats count number,
-    this is used in the montecarlo sampling by random.choice"""
-
-    res = {}
-    for prom, st in stats.items():
-        exp = []
-        for agent, count in st.items():
-            exp += [agent] * count
-        res[prom] = exp
+        to_fullfill &= ~(provides[randagent] | prom)
 
     return res
 
 
 def montecarlo(
-    exp_stats: Dict[Text, List[Text]],
-    agents: Dict[Text, Dict],
-    base: Set[Text],
-    stop_agents: Set[Text],
-    seeds: Set[Text],
-) -> Optional[Set[Text]]:
-    """find possible new set of agents"""
+    graph: AgentGraph,
+    base: int,
+    stop_agents: int,
+    seeds: int,
+    rng: Any = random,
+    missing: Optional[Counter] = None,
+    profile: Optional[Profile] = None,
+) -> Optional[int]:
+    """find possible new set of agents. Agents and promises are bitmasks
+    over the graph indexes, the bitmask of agents found is returned.
+    Requirements of failed runs are counted in missing (default:
+    missing_counter). With profile, sampling is timed and the chain depth
+    is counted"""
+
+    if missing is None:
+        missing = missing_counter
+
+    sample = (
+        sample_agent if profile is None else profile.timed("sampling", sample_agent)
+    )
 
-    # import pdb
+    requires = graph.requires
+    provides = graph.provides
 
-    # pdb.set_trace()
     # populate a set of requirements allready provided by the tecnique(s) in base
     allready_provides = seeds
-
-    for agent in base:
-        for prov in agents[agent]["provides"]:
-            allready_provides.add(prov)
-
-    res = set(base)
-
-    while base:
-        new_agent = set()
-        for agent in base:
-            sample = sample_agent(agent, agents, exp_stats, allready_provides)
-
-            for agent in sample:
-                allready_provides.update(agents[agent]["provides"])
-
-            new_agent.update(sample)
-
-        res.update(new_agent)
-
-        for agent in new_agent:
-            allready_provides.update(agents[agent]["provides"])
-
-        all_requirements_provided = True
-        for agent in res:
-            if not set(agents[agent]["requires"]).issubset(allready_provides):
-                all_requirements_provided = False
-
-        if all_requirements_provided:
-            for agent in res:
-                if agent in stop_agents:
-                    return res
+    # requirements of all the agents in the chain, so the chain is complete
+    # when needed & ~allready_provides is empty
+    needed = 0
+    for agent in bits(base):
+        allready_provides |= provides[agent]
+        needed |= requires[agent]
+
+    res = base
+    frontier = base
+    depth = 0
+
+    while frontier:
+        depth += 1
+        new_agent = 0
+        for agent in bits(frontier):
+            for sampled in sample(agent, graph, allready_provides, rng):
+                allready_provides |= provides[sampled]
+                needed |= requires[sampled]
+                new_agent |= 1 << sampled
+
+        res |= new_agent
+        unmet = needed & ~allready_provides
+
+        if not unmet and res & stop_agents:
+            if profile is not None:
+                profile.depth[depth] += 1
+            return res
 
         if not new_agent:
-            for agent in res:
-                for req in agents[agent]["requires"]:
-                    if req not in allready_provides:
-                        missing_counter[req] += 1
+            for agent in bits(res):
+                for req in bits(requires[agent] & unmet):
+                    missing[graph.promise_ids[req]] += 1
+            if profile is not None:
+                profile.depth[depth] += 1
             return None
 
-        base = new_agent
+        frontier = new_agent
 
     return None  # Can't get here, the conditional returns are in the while loop above.
 
@@ -252,148 +448,881 @@ def validates(
     return True
 
 
-def aggregate(agents: dict, strategy: str, data: Counter) -> Counter:
-    """aggregate a result based on a strategy"""
+class Query(NamedTuple):
+    """A simulation query, the seed promises and the base and stop agents
+    (bitmasks over the graph). With prune, providers that can not be
+    activated from the seeds are never drawn. With aggregation, the
+    accepted paths are aggregated (see aggregators.online) as they are
+    recorded"""
 
-    if not strategy:
-        return data
+    seeds: Tuple[Text, ...]
+    base: int
+    stop_agents: int
+    prune: bool = False
+    aggregation: Optional[Text] = None
 
-    strategies = {
-        "children": provreq.mcmc.aggregators.children.aggregate,
-        "equivalence": provreq.mcmc.aggregators.equivalence.aggregate,
-    }
 
-    if strategy not in strategies:
-        raise ValueError(f"Unknown aggregation strategy: {strategy}")
+def setup_worker(
+    graph: AgentGraph,
+    agents: Dict,
+    engine: Text = "reference",
+    validation_cache_size: int = 1_000_000,
+) -> None:
+    """Set the model used by run_share in this process. The validation
+    cache is shared by all queries run in the process"""
+
+    # unknown providers are re-drawn anyway, drop them once from the samplers
+    graph, _ = graph.prune()
+
+    _worker.update(
+        model_graph=graph,
+        graph=graph,
+        agents=agents,
+        engine=engine,
+        query=None,
+        validation_cache=ValidationCache(validation_cache_size),
+    )
+
 
-    return strategies[strategy](agents, data)  # type: ignore
+def _set_query(query: Query) -> None:
+    """Prepare the worker for simulations of query"""
 
+    if _worker["query"] == query:
+        return
 
-def main() -> None:
-    """main entry point"""
+    graph = _worker["model_graph"]
+    seeds_mask = graph.promise_mask(query.seeds)
+    if query.prune:
+        graph, _ = graph.prune(graph.reachable(seeds_mask))
 
-    args = command_line_arguments()
+    batch_engine = None
+    if _worker["engine"] == "numpy":
+        # numpy is an optional dependency, only needed for this engine
+        from provreq.mcmc.numpyengine import NumpyEngine
 
-    if os.path.isabs(args.stats):
-        stats_path = args.stats
-    else:
-        stats_path = os.path.join(args.data_dir, args.stats)
+        batch_engine = NumpyEngine(graph, query.base, query.stop_agents, seeds_mask)
+
+    aggregation = None
+    if query.aggregation:
+        aggregation = path_aggregation(graph, _worker["agents"], query.aggregation)
+
+    _worker.update(
+        graph=graph,
+        query=query,
+        seeds=list(query.seeds),
+        base=query.base,
+        stop_agents=query.stop_agents,
+        seeds_mask=seeds_mask,
+        batch_engine=batch_engine,
+        aggregation=aggregation,
+    )
 
-    with open(stats_path, encoding="utf8") as file_handle:
-        stats = json.load(file_handle)
 
-        agents, _, _ = config.read_agent_promises(args)
+def init_pool_worker(*args: Any) -> None:
+    """Pool initializer, leave ctrl-c/SIGTERM to the main process, which
+    stops the workers when the current batch is done"""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup_worker(*args)
+
+
+def _chains(
+    rng: random.Random,
+    missing: Counter,
+    profile: Optional[Profile] = None,
+    remaining: Optional[Callable[[], int]] = None,
+    stream: Optional[Any] = None,
+) -> Iterator[Optional[int]]:
+    """Endless stream of montecarlo results (None for failed chains) from
+    the engine set up for the current query. The missing requirements of
+    the failed chains are counted as the chains are taken from the stream.
+    The numpy engine runs the chains of stream (a numpyengine.ChainStream)
+    in batches, sized by remaining (the number of results still to accept)
+    so few chains are left over"""
+
+    batch_engine = _worker["batch_engine"]
+    graph = _worker["graph"]
+    base = _worker["base"]
+    stop_agents = _worker["stop_agents"]
+    seeds_mask = _worker["seeds_mask"]
+
+    if batch_engine is not None:
+        from provreq.mcmc.numpyengine import CHAINS, MIN_CHAINS
+
+        while True:
+            if not stream.pending:
+                chains = CHAINS
+                if remaining:
+                    # the chains expected to give the remaining results and
+                    # some to spare, or twice as many as taken until one is
+                    # accepted
+                    expected = (
+                        remaining() * stream.taken // stream.accepted * 9 // 8
+                        if stream.accepted
+                        else max(remaining(), stream.taken)
+                    )
+                    chains = min(CHAINS, max(MIN_CHAINS, expected))
+                with provreq.mcmc.profiling.phase(profile, "numpy engine"):
+                    stream.pending.extend(zip(*batch_engine.run(chains, stream.rng)))
+            sim, counts = stream.pending.popleft()
+            if counts:
+                missing.update(counts)
+            stream.taken += 1
+            yield sim
+
+    if profile is None:
+        while True:
+            yield montecarlo(graph, base, stop_agents, seeds_mask, rng, missing)
+
+    # chain expansion is the time in montecarlo besides sampling
+    seconds = profile.seconds
+    while True:
+        start = time.perf_counter()
+        sampling = seconds["sampling"]
+        sim = montecarlo(graph, base, stop_agents, seeds_mask, rng, missing, profile)
+        seconds["chain expansion"] += (
+            time.perf_counter() - start - (seconds["sampling"] - sampling)
+        )
+        yield sim
+
+
+# validation results are keyed by (seeds bitmask, agents bitmask)
+Learned = Dict[Tuple[int, int], bool]
+
+
+class ShareResult(NamedTuple):
+    """Result of the simulations run by run_share"""
+
+    paths: Counter
+    missing: Counter
+    attempts: int
+    accepted: int
+    rng_state: Any
+    learned: Learned
+    cache_hits: int
+    cache_misses: int
+    profile: Optional[Profile] = None
+    stream: Optional[Any] = None
+
+
+def run_share(
+    job: Tuple[Query, int, Any, Optional[Any], Learned, bool, Optional[float]],
+) -> ShareResult:
+    """Run simulations of query until n of them are accepted, or until the
+    deadline (time.time()) if given, continuing the random stream from
+    rng_state (and the chain stream of the numpy engine, started from
+    rng_state if None). learned are validation results from other workers,
+    which are added to the validation cache first. The paths are aggregated
+    if the query has an aggregation. With profiling, the result has the
+    profile of the simulations"""
+
+    query, n, rng_state, stream, learned, profiling, deadline = job
+    _set_query(query)
+
+    rng = random.Random()
+    rng.setstate(rng_state)
+    if _worker["batch_engine"] is not None and stream is None:
+        from provreq.mcmc.numpyengine import ChainStream
+
+        stream = ChainStream(rng.getrandbits(64))
+
+    graph = _worker["graph"]
+    seeds_mask = _worker["seeds_mask"]
+    cache = _worker["validation_cache"]
+    aggregation = _worker["aggregation"]
+    cache.update(learned)
+    hits, misses = cache.hits, cache.misses
+
+    profile = Profile() if profiling else None
+    validate = validates if profile is None else profile.timed("validation", validates)
+
+    c: Counter = Counter()
+    missing: Counter = Counter()
+    i = attempts = 0
+    chains = _chains(rng, missing, profile, lambda: n - i, stream)
+    while i < n:
+        # at least 64 attempts per slice, so every slice makes progress
+        if (
+            deadline is not None
+            and attempts
+            and not attempts % 64
+            and time.time() > deadline
+        ):
+            break
+        sim = next(chains)
+        attempts += 1
+        if sim is None:
+            if profile is not None:
+                profile.rejected["dead end"] += 1
+            continue
+        if cache.validate(
+            (seeds_mask, sim),
+            lambda: validate(
+                _worker["seeds"], graph.agent_names(sim), _worker["agents"], []
+            ),
+        ):
+            c[sim if aggregation is None else aggregation(sim)] += 1
+            i += 1
+            if profile is not None:
+                profile.bundles.add(sim)
+            if stream is not None:
+                stream.accepted += 1
+        elif profile is not None:
+            profile.rejected["failed validation"] += 1
+
+    if profile is not None:
+        profile.attempts = attempts
+        profile.accepted = i
+
+    return ShareResult(
+        c,
+        missing,
+        attempts,
+        i,
+        rng.getstate(),
+        cache.take_learned(),
+        cache.hits - hits,
+        cache.misses - misses,
+        profile,
+        stream,
+    )
+
 
-        if args.stop_agents:
-            stop_agents = args.stop_agents
-        elif args.stop_agent_class:
-            stop_agents = {
-                agent
-                for agent, data in agents.items()
-                if args.stop_agent_class in data["agent_class"]
-            }
+class Run:
+    """The simulations of a query, accumulated batch by batch. Each batch is
+    shared between the workers (one per random stream in rng_states), and
+    the random streams (and the chain streams of the numpy engine, in
+    streams) are continued from batch to batch. With profile, the
+    profiles of the workers are merged into it. With summary, only the
+    heavy hitters of the paths are kept (paths is the counter of summary).
+    With choke_mask, chokes is kept as the choke_counts of the paths, or
+    with summary (where the distinct paths are not known) as the runs of
+    each agent in choke_mask"""
+
+    def __init__(
+        self,
+        query: Query,
+        rng_states: List[Any],
+        missing: Optional[Counter] = None,
+        profile: Optional[Profile] = None,
+        summary: Optional[HeavyHitters] = None,
+        choke_mask: Optional[int] = None,
+    ) -> None:
+        self.query = query
+        self.profile = profile
+        self.summary = summary
+        self.rng_states = rng_states
+        self.streams: List[Optional[Any]] = [None] * len(rng_states)
+        # what each worker still owes of a stopped batch
+        self.owed = [0] * len(rng_states)
+        self.paths: Counter = Counter() if summary is None else summary.counts
+        self.missing: Counter = Counter() if missing is None else missing
+        self.choke_mask = choke_mask
+        self.chokes: Counter = Counter()
+        self.accepted = 0
+        self.attempted = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.learned: Learned = {}
+
+    def batch(
+        self,
+        todo: int,
+        pool: Optional[Any] = None,
+        stop: Optional[Callable[[], bool]] = None,
+    ) -> None:
+        """Run simulations until todo more are accepted, in pool if given.
+        With stop, the workers return every SLICE_SECONDS to check it, and
+        the batch ends early if it returns True. The rest of a batch that
+        was stopped is run in place of todo by the next call, so the random
+        streams are continued as if the batch was run in one go"""
+
+        workers = len(self.rng_states)
+        if not any(self.owed):
+            self.owed = [
+                todo // workers + (worker < todo % workers) for worker in range(workers)
+            ]
+        while any(self.owed):
+            deadline = time.time() + SLICE_SECONDS if stop else None
+            jobs = [
+                (
+                    self.query,
+                    self.owed[worker],
+                    self.rng_states[worker],
+                    self.streams[worker],
+                    self.learned,
+                    self.profile is not None,
+                    deadline,
+                )
+                for worker in range(workers)
+            ]
+            results = pool.map(run_share, jobs) if pool else list(map(run_share, jobs))
+            self._merge(results, pool is not None)
+            for worker, result in enumerate(results):
+                self.owed[worker] -= result.accepted
+
+            if stop and stop():
+                break
+
+    def _merge(self, results: List[ShareResult], shared: bool) -> None:
+        """Add the results of the workers, and with shared what they
+        validated to the validation results sent to the others"""
+
+        self.learned = {}
+        for worker, result in enumerate(results):
+            if self.summary is None:
+                if self.choke_mask is not None:
+                    # only the new paths change the counts of distinct paths
+                    for sim in result.paths:
+                        if sim not in self.paths:
+                            self.chokes.update(bits(sim & self.choke_mask))
+                self.paths.update(result.paths)
+            else:
+                self.summary.update(result.paths)
+            self.missing.update(result.missing)
+            self.attempted += result.attempts
+            self.accepted += result.accepted
+            self.rng_states[worker] = result.rng_state
+            self.streams[worker] = result.stream
+            self.cache_hits += result.cache_hits
+            self.cache_misses += result.cache_misses
+            if self.profile is not None and result.profile is not None:
+                self.profile.merge(result.profile)
+            # share what each worker validated with the others
+            if shared:
+                self.learned.update(result.learned)
+
+        if self.summary is not None:
+            self._count_chokes()
+
+    def _count_chokes(self) -> None:
+        """Count the choke points of all the paths"""
+
+        if self.choke_mask is None:
+            return
+
+        if self.summary is None:
+            self.chokes = choke_counts(self.paths, self.choke_mask)
         else:
-            stop_agents = {
-                agent
-                for agent, data in agents.items()
-                if "Initial Access" in data["agent_class"]
-            }
-
-        if args.pre_seed_stop_agent_requirements:
-            for agent in stop_agents:
+            self.chokes = Counter(
+                {
+                    idx: runs
+                    for idx, runs in self.summary.agent_runs.items()
+                    if self.choke_mask >> idx & 1
+                }
+            )
+
+    def state(self) -> Dict[Text, Any]:
+        """The results and random streams, for checkpoints"""
+
+        return {
+            "paths": self.paths,
+            "summary": self.summary,
+            "missing": self.missing,
+            "accepted": self.accepted,
+            "attempted": self.attempted,
+            "rng_states": self.rng_states,
+            "streams": self.streams,
+            "owed": self.owed,
+        }
+
+    def restore(self, state: Dict[Text, Any]) -> None:
+        """Continue from a state returned by state"""
+
+        # the paths of a summary are restored as its counter
+        self.summary = state.get("summary")
+        self.paths = state["paths"]
+        self.missing.update(state["missing"])
+        self.accepted = state["accepted"]
+        self.attempted = state["attempted"]
+        self.rng_states = state["rng_states"]
+        self.streams = state["streams"]
+        self.owed = state["owed"]
+        self._count_chokes()
+
+    def result(self, graph: AgentGraph) -> Dict[Text, Any]:
+        """The results with agent IDs in place of bitmasks, for the result
+        cache"""
+
+        return {
+            "paths": [
+                (graph.agent_names(sim), count) for sim, count in self.paths.items()
+            ],
+            "missing": dict(self.missing),
+            "accepted": self.accepted,
+            "attempted": self.attempted,
+        }
+
+    def restore_result(self, graph: AgentGraph, result: Dict[Text, Any]) -> None:
+        """Use the results returned by result in place of simulating"""
+
+        self.paths = Counter(
+            {graph.agent_mask(agents): count for agents, count in result["paths"]}
+        )
+        self.missing.update(result["missing"])
+        self.accepted = result["accepted"]
+        self.attempted = result["attempted"]
+        self._count_chokes()
+
+    def cache_summary(self) -> Text:
+        """Validation cache hits and misses"""
+
+        total = max(1, self.cache_hits + self.cache_misses)
+        return (
+            f"{self.cache_hits} hits, {self.cache_misses} misses "
+            f"({round(self.cache_hits / total * 10000) / 100}% hit rate)"
+        )
+
+
+def query_params(
+    query: Query,
+    agents: List[Text],
+    stop_agents: Set[Text],
+    engine: Text,
+    workers: int,
+    approximate: Optional[int] = None,
+) -> Dict[Text, Any]:
+    """Normalized parameters the simulations of a query depend on (besides
+    the number of runs and the random seed), approximate is the capacity of
+    the heavy hitters summary if only the top paths are kept"""
+
+    return {
+        "seeds": list(query.seeds),
+        "agents": sorted(agents),
+        "stop_agents": sorted(stop_agents),
+        "engine": engine,
+        "workers": workers,
+        "prune": query.prune,
+        "aggregation": query.aggregation,
+        "approximate": approximate,
+    }
+
+
+def pruned_providers(graph: AgentGraph, query: Query) -> Dict[Text, List[Text]]:
+    """The providers the workers remove from the samplers for query (provider
+    -> promises): unknown agents, and with query.prune agents that can not
+    be activated from the seeds"""
+
+    keep = graph.reachable(graph.promise_mask(query.seeds)) if query.prune else None
+    _, removed = graph.prune(keep)
+
+    return removed
+
+
+def unsatisfiable(graph: AgentGraph, query: Query) -> List[Text]:
+    """Why no path of query can validate (and the simulations would never
+    finish): there are no base agents, or base agents, or all the stop
+    agents, can not be activated from the seeds"""
+
+    if not query.base:
+        return ["No agents to find paths to"]
+
+    reachable = graph.reachable(graph.promise_mask(query.seeds))
+
+    problems = []
+    unreachable = graph.agent_names(query.base & ~reachable)
+    if unreachable:
+        problems.append(f"{', '.join(unreachable)} can not be activated from the seeds")
+    if not query.stop_agents & reachable:
+        problems.append("None of the stop agents can be activated from the seeds")
+
+    return problems
+
+
+def cache_key(
+    cache: ResultCache,
+    sources: Dict[Text, Text],
+    params: Dict[Text, Any],
+    runs: int,
+    random_seed: Optional[int],
+    converge: Optional[float],
+    top: int,
+) -> Optional[Text]:
+    """Result cache key of a query, None if the results are not
+    reproducible (no random seed)"""
+
+    if random_seed is None:
+        return None
+
+    return cache.key(
+        sources,
+        {
+            **params,
+            "runs": runs,
+            "random_seed": random_seed,
+            "converge": converge,
+            # the convergence monitor looks at the top paths
+            "top": top if converge else None,
+        },
+    )
+
+
+def resolve_stop_agents(
+    agents: Dict,
+    stop_agents: Optional[List[Text]] = None,
+    stop_agent_class: Optional[Text] = None,
+) -> Set[Text]:
+    """The stop agents, or all agents of stop_agent_class, default all
+    Initial Access agents"""
+
+    if stop_agents:
+        return set(stop_agents)
+
+    agent_class = stop_agent_class or "Initial Access"
+    return {
+        agent for agent, data in agents.items() if agent_class in data["agent_class"]
+    }
+
+
+def resolve_seeds(
+    agents: Dict,
+    seeds: Optional[List[Text]],
+    stop_agents: Set[Text],
+    pre_seed_stop_agent_requirements: bool = False,
+    seed_class: Optional[List[Text]] = None,
+    verbose: bool = True,
+) -> List[Text]:
+    """The seed promises, with the requirements of the stop agents and the
+    promises of the agents in seed_class added if asked for"""
+
+    seeds = list(seeds or [])
+
+    if pre_seed_stop_agent_requirements:
+        for agent in stop_agents:
+            if verbose:
                 print(
                     f"Adding {agents[agent]['requires']} to the pre seeding due to stop agent {agent}"
                 )
-                args.seeds += agents[agent]["requires"]
-            args.seeds = list(set(args.seeds))
-
-        if args.seed_class:
-            seed_agents = []
-            for tid, agent in agents.items():
-                if any(
-                    seed_class in agent["agent_class"] for seed_class in args.seed_class
-                ):
-                    seed_agents += agent["provides"]
+            seeds += agents[agent]["requires"]
+        seeds = list(set(seeds))
+
+    if seed_class:
+        seed_agents = []
+        for agent in agents.values():
+            if any(cls in agent["agent_class"] for cls in seed_class):
+                seed_agents += agent["provides"]
+        if verbose:
             print(
                 (
-                    f"Pre-seeding with {set(seed_agents)} from {', '.join(args.seed_class)} "
-                    f"agent class{'es' if len(args.seed_class) > 1 else ''}."
+                    f"Pre-seeding with {set(seed_agents)} from {', '.join(seed_class)} "
+                    f"agent class{'es' if len(seed_class) > 1 else ''}."
                 )
             )
-            args.seeds = list(set(args.seeds + seed_agents))
+        seeds = list(set(seeds + seed_agents))
 
-        ignore_choke = stop_agents.union(set(args.agents))
+    return seeds
 
-        if not stop_agents:
-            sys.stderr.write("Stop agents can not be empty!\n")
-            sys.exit(1)
 
-        c: Counter = Counter()
+def worker_rng_states(seed: Optional[int], workers: int) -> List[Any]:
+    """Independent random streams for each worker, derived from seed"""
 
-        exp_stats = expand_stats_list(stats)
-        i = 0
-        n = args.runs
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
 
-        for seed in args.seeds:
-            for k in agents:
-                if seed in agents[k]["provides"]:
-                    if args.hints:
-                        print(
-                            f"You could use {k} {agents[k]['name']} in place of {seed}"
-                        )
+    return [random.Random(f"{seed}/{worker}").getstate() for worker in range(workers)]
 
-        start = datetime.datetime.now()
-        pbar = ProgressBar("Simulating", n)
 
-        while i < n:
-            sim = montecarlo(
-                exp_stats, agents, set(args.agents), stop_agents, set(args.seeds)
-            )
-            if sim:
-                sim.update(args.agents)
-                # If it is allready stored, it is also allready validated.
-                if c[frozenset(sim)] > 0 or validates(
-                    args.seeds, list(sim), agents, []
-                ):
-                    c[frozenset(sim)] += 1
-                    i += 1
-                    pbar.update(i)
-
-        stop = datetime.datetime.now()
-        delta = stop - start
-        pbar.done(f"done in {delta}")
+def report_agents(agents: dict, strategy: str) -> dict:
+    """The agents of paths aggregated with strategy, with the aggregated
+    agents of the equivalence strategy added"""
 
-        print(
-            "Simulations ending due to missing requirements.. (stats for runs that did not complete)"
+    if strategy == "equivalence":
+        index = provreq.mcmc.aggregators.equivalence.EquivalenceIndex(agents)
+        return index.merged(agents)
+
+    return agents
+
+
+def main() -> None:
+    """main entry point"""
+
+    args = command_line_arguments()
+
+    agents, graph = provreq.mcmc.model.load_model(
+        args, provreq.mcmc.model.stats_file(args)
+    )
+
+    if not args.agents:
+        sys.stderr.write("--agents can not be empty\n")
+        sys.exit(1)
+
+    # unknown agents are not in the bitmasks, and the paths would never end
+    unknown = [
+        agent
+        for agent in args.agents + (args.stop_agents or [])
+        if agent not in graph.agent_index
+    ]
+    if unknown:
+        sys.stderr.write(f"Unknown agents: {', '.join(unknown)}\n")
+        sys.exit(1)
+
+    stop_agents = resolve_stop_agents(agents, args.stop_agents, args.stop_agent_class)
+    args.seeds = resolve_seeds(
+        agents,
+        args.seeds,
+        stop_agents,
+        args.pre_seed_stop_agent_requirements,
+        args.seed_class,
+    )
+
+    if not stop_agents:
+        sys.stderr.write("Stop agents can not be empty!\n")
+        sys.exit(1)
+
+    if args.approximate and (args.raw_paths or args.result_cache):
+        sys.stderr.write(
+            "--approximate can not be used with --raw-paths or --result-cache\n"
         )
+        sys.exit(1)
+
+    try:
+        aggregation = path_aggregation(graph, agents, args.aggregation)
+    except ValueError as err:
+        sys.stderr.write(f"{err}\n")
+        sys.exit(1)
+
+    query = Query(
+        tuple(sorted(args.seeds)),
+        graph.agent_mask(args.agents),
+        graph.agent_mask(stop_agents),
+        args.prune_unreachable,
+        None if args.raw_paths else args.aggregation or None,
+    )
+
+    # the paths are of the aggregated classes, unless they are raw
+    ignore_choke = stop_agents.union(set(args.agents))
+    labels = graph.agent_ids
+    if query.aggregation:
+        ignore_choke = aggregation.ignored(ignore_choke)
+        labels = aggregation.labels
+
+    n = args.runs
+
+    removed = pruned_providers(graph, query)
+    if removed:
+        print("Providers removed from the samplers")
         print(
             tabulate.tabulate(
-                missing_counter.items(),
-                headers=["promise", "count"],
+                [
+                    (
+                        agent,
+                        "unreachable" if agent in graph.agent_index else "unknown",
+                        len(promises),
+                    )
+                    for agent, promises in sorted(removed.items())
+                ],
+                headers=["provider", "reason", "promises"],
                 tablefmt="fancy_grid",
             )
         )
 
-        print("Top choke points")
-        print(
-            tabulate.tabulate(
-                find_choke_points(c, agents, ignore_choke).most_common(5),
-                headers=["Agent", "Count"],
-                tablefmt="fancy_grid",
+    problems = unsatisfiable(graph, query)
+    if problems:
+        sys.stderr.write(f"{'; '.join(problems)}, no path will validate\n")
+        sys.exit(1)
+
+    for seed in args.seeds:
+        for k in agents:
+            if seed in agents[k]["provides"]:
+                if args.hints:
+                    print(f"You could use {k} {agents[k]['name']} in place of {seed}")
+
+    workers = max(1, args.workers)
+    worker_args = (graph, agents, args.engine, args.validation_cache_size)
+    profile = Profile() if args.profile else None
+    choke_mask = choke_agents_mask(graph, ignore_choke)
+    run = Run(
+        query,
+        worker_rng_states(args.random_seed, workers),
+        missing_counter,
+        profile,
+        HeavyHitters(args.approximate) if args.approximate else None,
+        choke_mask,
+    )
+
+    monitor = ConvergenceMonitor(args.top, args.converge) if args.converge else None
+
+    # what the paths in a checkpoint depend on, checked on --resume
+    sources = provreq.mcmc.model.source_hashes(
+        provreq.mcmc.model.source_files(args, provreq.mcmc.model.stats_file(args))
+    )
+    params = query_params(
+        query, args.agents, stop_agents, args.engine, workers, args.approximate
+    )
+    checkpoint_query = {"sources": sources, "agent_ids": graph.agent_ids, **params}
+
+    result_cache = None
+    key = cached = None
+    if args.result_cache:
+        result_cache = ResultCache(
+            args.result_cache, args.result_cache_size * 1024 * 1024
+        )
+        key = cache_key(
+            result_cache, sources, params, n, args.random_seed, args.converge, args.top
+        )
+        cached = result_cache.get(key) if key else None
+
+    if cached:
+        run.restore_result(graph, cached)
+        print(f"Using cached result from {args.result_cache}")
+    elif args.resume:
+        if not args.checkpoint:
+            sys.stderr.write("--resume requires --checkpoint\n")
+            sys.exit(1)
+        state = provreq.mcmc.checkpoint.load(args.checkpoint)
+        if state["query"] != checkpoint_query:
+            sys.stderr.write(
+                f"{args.checkpoint} is from a different query, model or "
+                "number of workers\n"
             )
+            sys.exit(1)
+        run.restore(state)
+        if monitor and state["monitor"]:
+            monitor.restore(state["monitor"])
+        print(f"Resuming from {args.checkpoint} after {run.accepted} runs")
+
+    def write_checkpoint() -> None:
+        provreq.mcmc.checkpoint.save(
+            args.checkpoint,
+            {
+                "query": checkpoint_query,
+                "monitor": monitor.state() if monitor else None,
+                **run.state(),
+            },
         )
 
-        c = aggregate(agents, args.aggregation, c)
+    pool = None
+    if workers > 1 and not cached:
+        pool = multiprocessing.Pool(
+            workers, initializer=init_pool_worker, initargs=worker_args
+        )
+    else:
+        setup_worker(*worker_args)
+
+    last_checkpoint = time.monotonic()
 
+    start = datetime.datetime.now()
+    pbar = ProgressBar("Simulating", n, initial=run.accepted)
+
+    while not cached and run.accepted < n:
+        with provreq.mcmc.profiling.phase(profile, "simulation (wall)"):
+            run.batch(
+                min(n - run.accepted, BATCH_SIZE * workers),
+                pool,
+                lambda: bool(interrupted),
+            )
+        pbar.update(run.accepted, run.attempted)
+
+        # a stopped batch may be partial, check convergence on whole ones
+        if interrupted:
+            break
+
+        if monitor and monitor.check(run.paths, run.chokes, run.accepted):
+            break
+
+        if (
+            args.checkpoint
+            and time.monotonic() - last_checkpoint >= args.checkpoint_interval
+        ):
+            write_checkpoint()
+            last_checkpoint = time.monotonic()
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if args.checkpoint:
+        write_checkpoint()
+
+    converged = cached["converged"] if cached else monitor and monitor.reason
+    if result_cache and key and not cached and not interrupted:
+        result_cache.put(key, {**run.result(graph), "converged": converged})
+
+    i = run.accepted
+
+    stop = datetime.datetime.now()
+    delta = stop - start
+    pbar.done(f"done in {delta}")
+
+    if converged:
+        print(f"Converged after {i} runs: {converged}")
+    if interrupted:
+        print(f"Interrupted after {i} of {n} runs, showing partial results")
+    if args.checkpoint:
+        print(f"Checkpoint written to {args.checkpoint}")
+    n = i
+
+    print(f"Validation cache: {run.cache_summary()}")
+
+    print(
+        "Simulations ending due to missing requirements.. (stats for runs that did not complete)"
+    )
+    print(
+        tabulate.tabulate(
+            missing_counter.items(),
+            headers=["promise", "count"],
+            tablefmt="fancy_grid",
+        )
+    )
+
+    shown = report_agents(agents, args.aggregation)
+
+    with provreq.mcmc.profiling.phase(profile, "aggregation"):
+        chokes = [
+            (f"{labels[idx]}: {shown[labels[idx]]['name']}", count)
+            for idx, count in run.chokes.most_common(5)
+        ]
+
+    print("Top choke points")
+    print(
+        tabulate.tabulate(
+            chokes,
+            headers=["Agent", "Runs" if run.summary else "Count"],
+            tablefmt="fancy_grid",
+        )
+    )
+
+    if args.analysis:
+        with provreq.mcmc.profiling.phase(profile, "analysis"):
+            from provreq.mcmc.analysis import analyse
+
+            analysis = analyse(run.paths, labels, ignore_choke)
+        print_analysis(analysis, shown)
+
+    with provreq.mcmc.profiling.phase(profile, "aggregation"):
+        c = aggregation.remap(run.paths)
+
+    # upper bounds of the counts, the paths of a summary are never raw so
+    # remap does not merge them
+    upper = {}
+    if run.summary:
+        upper = {
+            frozenset(aggregation.names(sim)): run.summary.bounds(sim)[1]
+            for sim in run.paths
+        }
+        print(
+            f"Approximate counts: {len(c)} paths kept (capacity "
+            f"{run.summary.capacity}), the counts are up to "
+            f"{run.summary.error} runs low"
+        )
+    else:
         print(f"Total number of potensial 'paths': {len(c)}")
-        print(f"Top {args.top}")
-        for res in c.most_common(args.top):
-            print(f"{round(res[1] / n * 10000) / 100}% (n={res[1]})")
-            sim = simulate(args.seeds, set(res[0]), agents, [])
+    print(f"Top {args.top}")
+    for res in c.most_common(args.top):
+        with provreq.mcmc.profiling.phase(profile, "report"):
+            if upper:
+                print(
+                    f"{round(res[1] / n * 10000) / 100}% "
+                    f"(n={res[1]}, at most {upper[res[0]]})"
+                )
+            else:
+                print(f"{round(res[1] / n * 10000) / 100}% (n={res[1]})")
+            sim = simulate(args.seeds, set(res[0]), shown, [])
 
             print(
                 tabulate.tabulate(
-                    stages_table(sim, agents, True, True),
+                    stages_table(sim, shown, True, True),
                     headers="keys",
                     tablefmt="fancy_grid",
                 )
@@ -401,14 +1330,104 @@ def main() -> None:
 
             print("---")
 
+    if profile:
+        write_profile(profile, args.profile)
+
+
+def print_analysis(analysis: Dict[Text, Any], agents: Dict) -> None:
+    """Print the tables of a path analysis (see provreq.mcmc.analysis)"""
+
+    print("Weighted choke points (share of the runs through the agent)")
+    print(
+        tabulate.tabulate(
+            [
+                (
+                    f"{row['agent']}: {agents[row['agent']]['name']}",
+                    round(row["runs"]),
+                    f"{row['share'] * 100:.2f}%",
+                )
+                for row in analysis["choke_points"]
+            ],
+            headers=["Agent", "Runs", "Share"],
+            tablefmt="fancy_grid",
+        )
+    )
+
+    print("Removal order (share of the runs removed by removing the agents so far)")
+    print(
+        tabulate.tabulate(
+            [
+                (
+                    f"{row['agent']}: {agents[row['agent']]['name']}",
+                    f"{row['removed'] * 100:.2f}%",
+                )
+                for row in analysis["removal"]
+            ],
+            headers=["Agent", "Removed"],
+            tablefmt="fancy_grid",
+        )
+    )
+
+    conditional = analysis["conditional"]
+    print("Co-occurrence of the top choke points, P(column | row)")
+    print(
+        tabulate.tabulate(
+            [
+                [row]
+                + [
+                    f"{conditional[row][col] * 100:.1f}%" if col != row else "-"
+                    for col in conditional
+                ]
+                for row in conditional
+            ],
+            headers=[""] + list(conditional),
+            tablefmt="fancy_grid",
+        )
+    )
+
+
+def write_profile(profile: Profile, filename: Text) -> None:
+    """Print the profile tables and write the profile to filename (JSON)"""
+
+    phases, chains, depths = profile.tables()
+    print("Profile (worker phases are summed over the workers)")
+    print(
+        tabulate.tabulate(phases, headers=["phase", "seconds"], tablefmt="fancy_grid")
+    )
+    print(
+        tabulate.tabulate(
+            chains, headers=["chains", "count", "%"], tablefmt="fancy_grid"
+        )
+    )
+    if depths:
+        print(
+            tabulate.tabulate(
+                depths, headers=["chain depth", "count"], tablefmt="fancy_grid"
+            )
+        )
+
+    with open(filename, "w", encoding="utf-8") as file_handle:
+        json.dump(profile.as_dict(), file_handle, indent=2)
+    print(f"Profile written to {filename}")
+
+
+def choke_agents_mask(graph: AgentGraph, ignore: Set[Text]) -> int:
+    """Bitmask of the agents reported as choke points: the techniques (T...)
+    not in ignore"""
+
+    return graph.agent_mask(
+        agent
+        for agent in graph.agent_ids
+        if agent.startswith("T") and agent not in ignore
+    )
+
 
-def find_choke_points(sims: Counter, agents: Dict, ignore: Set) -> Counter:
-    """Find choke points in simulation"""
+def choke_counts(sims: Counter, choke_mask: int) -> Counter:
+    """Number of distinct paths (bitmasks) each agent in choke_mask is in,
+    the ranking of the choke points"""
 
     c: Counter = Counter()
-    for sim, n in sims.items():
-        for agent in sim:
-            if agent.startswith("T") and agent not in ignore:
-                c[f"{agent}: {agents[agent]['name']}"] += 1
+    for sim in sims:
+        c.update(bits(sim & choke_mask))
 
     return c
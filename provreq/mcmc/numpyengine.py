@@ -0,0 +1,229 @@
+"""Batched montecarlo engine advancing many chains in lockstep with numpy.
+
+The state of all chains is held in bitmask matrices of 64 bit words (chains
+x agent words and chains x promise words). Each round draws providers for
+the open requirements of the frontier agents in the same order as
+montecarlo.montecarlo (agent index, then promise index), but for all chains
+with the agent in their frontier at once, and completion, stop agent and
+dead end checks are word reductions.
+
+The only difference to montecarlo.montecarlo is that an agent with a
+requirement never seen in the stats is skipped when the round starts,
+instead of when that requirement is reached."""
+
+from collections import Counter, deque
+from typing import Any, Deque, List, Optional, Tuple
+
+import numpy as np
+
+from provreq.mcmc.graph import AgentGraph, bits
+
+# Max number of chains advanced in lockstep per batch
+CHAINS = 4096
+
+# Min number of chains per batch, when fewer results are needed
+MIN_CHAINS = 64
+
+# The bit of each index in a 64 bit word
+BIT = np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))
+
+
+def words(mask: int, n_words: int) -> np.ndarray:
+    """Bitmask as n_words little endian 64 bit words"""
+
+    return np.frombuffer(mask.to_bytes(8 * n_words, "little"), dtype="<u8")
+
+
+def word_matrix(masks: List[int], n_bits: int) -> np.ndarray:
+    """Bitmasks of n_bits as the rows of a matrix of 64 bit words"""
+
+    n_words = (n_bits + 63) // 64
+    return np.array([words(mask, n_words) for mask in masks], dtype="<u8").reshape(
+        len(masks), n_words
+    )
+
+
+def set_bits(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Row and index of the set bits of a matrix of 64 bit words, by row and
+    then index. Only the words that are not 0 are unpacked"""
+
+    rows, cols = np.nonzero(matrix)
+    unpacked = np.unpackbits(
+        matrix[rows, cols].astype("<u8").view(np.uint8).reshape(-1, 8),
+        axis=1,
+        bitorder="little",
+    )
+    word, bit = np.nonzero(unpacked)
+
+    return rows[word], cols[word] * 64 + bit
+
+
+class ChainStream:
+    """The random stream of a NumpyEngine for one worker, with the chains
+    run but not taken yet. It is kept from share to share, so the results
+    do not depend on where a batch is cut. taken and accepted are the
+    chains taken and accepted so far, to size the next batch of chains"""
+
+    def __init__(self, seed: int) -> None:
+        self.rng = np.random.default_rng(seed)
+        self.pending: Deque[Tuple[Optional[int], Optional[Counter]]] = deque()
+        self.taken = 0
+        self.accepted = 0
+
+
+class NumpyEngine:
+    """Word matrices and sampler tables of a graph and a query (base agents,
+    stop agents and seeds as bitmasks over the graph indexes)"""
+
+    def __init__(
+        self, graph: AgentGraph, base: int, stop_agents: int, seeds: int
+    ) -> None:
+        n_agents = len(graph.agent_ids)
+        n_promises = len(graph.promise_ids)
+
+        self.graph = graph
+        self.n_agents = n_agents
+        self.n_promises = n_promises
+        self.requires = word_matrix(graph.requires, n_promises)
+        self.provides = word_matrix(graph.provides, n_promises)
+
+        # agents requiring each promise, to count the missing requirements
+        required_by = [0] * n_promises
+        for agent, reqs in enumerate(graph.requires):
+            for req in bits(reqs):
+                required_by[req] |= 1 << agent
+        self.required_by = word_matrix(required_by, n_agents)
+
+        # Providers not in agents are dropped from the tables, which gives
+        # the same distribution as re-drawing them like sample_agent does
+        self.tables: List[Optional[Tuple[np.ndarray, np.ndarray]]] = []
+        for sampler in graph.samplers:
+            table = None
+            if sampler is not None:
+                counts = {
+                    agent: count
+                    for agent, count in sampler.counts().items()
+                    if agent >= 0
+                }
+                if counts:
+                    table = (
+                        np.fromiter(counts.keys(), dtype=np.int64),
+                        np.cumsum(np.fromiter(counts.values(), dtype=np.int64)),
+                    )
+            self.tables.append(table)
+
+        # Requirements of each agent with providers to draw from, and the
+        # words of those without
+        self.sampled: List[List[int]] = []
+        self.unsampled: List[Optional[np.ndarray]] = []
+        for agent in range(n_agents):
+            reqs = list(bits(graph.requires[agent]))
+            self.sampled.append([req for req in reqs if self.tables[req] is not None])
+            unsampled = sum(1 << req for req in reqs if self.tables[req] is None)
+            self.unsampled.append(
+                words(unsampled, self.requires.shape[1]) if unsampled else None
+            )
+
+        provided = seeds
+        needed = 0
+        for agent in bits(base):
+            provided |= graph.provides[agent]
+            needed |= graph.requires[agent]
+
+        n_agent_words = (n_agents + 63) // 64
+        self.base = words(base, n_agent_words)
+        self.stop = words(stop_agents, n_agent_words)
+        self.provided = words(provided, self.requires.shape[1])
+        self.needed = words(needed, self.requires.shape[1])
+
+    def run(
+        self, chains: int, rng: Any
+    ) -> Tuple[List[Optional[int]], List[Optional[Counter]]]:
+        """Run a batch of chains with the numpy Generator rng. Return the
+        bitmask of agents of each chain (None for failed chains), and a
+        counter of the requirements missing in each failed chain (by promise
+        ID, None for successful chains), both in chain order"""
+
+        paths: List[Optional[int]] = [None] * chains
+        missing: List[Optional[Counter]] = [None] * chains
+        promise_ids = self.graph.promise_ids
+
+        res = np.tile(self.base, (chains, 1))
+        provided = np.tile(self.provided, (chains, 1))
+        needed = np.tile(self.needed, (chains, 1))
+        frontier = res.copy()
+        # the chain of each row
+        ids = np.arange(chains)
+
+        # Every round provides at least one new promise, or the chain ends
+        for _ in range(self.n_promises + 1):
+            if not res.shape[0]:
+                break
+
+            # (agent, row) of the frontiers, by agent and then row
+            rows, agents = set_bits(frontier)
+            order = np.argsort(agents, kind="stable")
+            rows, agents = rows[order], agents[order]
+            agent_list, starts = np.unique(agents, return_index=True)
+
+            drawn = np.zeros_like(res)
+            for agent, rows_agent in zip(
+                agent_list.tolist(), np.split(rows, starts[1:])
+            ):
+                unsampled = self.unsampled[agent]
+                if unsampled is not None:
+                    rows_agent = rows_agent[
+                        ((provided[rows_agent] & unsampled) == unsampled).all(axis=1)
+                    ]
+                for prom in self.sampled[agent]:
+                    rows_prom = rows_agent[
+                        (provided[rows_agent, prom >> 6] & BIT[prom & 63]) == 0
+                    ]
+                    if not rows_prom.size:
+                        continue
+                    providers, cumulative = self.tables[prom]
+                    chosen = providers[
+                        np.searchsorted(
+                            cumulative,
+                            rng.integers(cumulative[-1], size=rows_prom.size),
+                            side="right",
+                        )
+                    ]
+                    # one draw per row, so the rows can be updated in place
+                    drawn[rows_prom, chosen >> 6] |= BIT[chosen & 63]
+                    provided[rows_prom] |= self.provides[chosen]
+                    needed[rows_prom] |= self.requires[chosen]
+
+            res |= drawn
+            unmet = needed & ~provided
+
+            done = (res & self.stop).any(axis=1) & ~unmet.any(axis=1)
+            dead = ~done & ~drawn.any(axis=1)
+
+            for row in np.flatnonzero(done).tolist():
+                paths[ids[row]] = int.from_bytes(res[row].tobytes(), "little")
+
+            if dead.any():
+                dead_rows = np.flatnonzero(dead)
+                for row in dead_rows.tolist():
+                    missing[ids[row]] = Counter()
+                # number of agents in each failed chain requiring each unmet
+                # promise
+                rows, proms = set_bits(unmet[dead_rows])
+                counts = np.unpackbits(
+                    (res[dead_rows[rows]] & self.required_by[proms]).view(np.uint8),
+                    axis=1,
+                ).sum(axis=1)
+                for row, prom, count in zip(
+                    dead_rows[rows].tolist(), proms.tolist(), counts.tolist()
+                ):
+                    missing[ids[row]][promise_ids[prom]] += count
+
+            keep = ~(done | dead)
+            res = res[keep]
+            provided = provided[keep]
+            needed = needed[keep]
+            frontier = drawn[keep]
+            ids = ids[keep]
+
+        return paths, missing
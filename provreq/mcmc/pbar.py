@@ -1,47 +1,96 @@
-import os
+import shutil
 import sys
 import time
+from typing import IO, Optional
+
+
+def _duration(seconds: float) -> str:
+    """Format seconds as a short duration"""
+
+    if seconds > 60 * 60:
+        return "{:.0f}h".format(seconds / (60 * 60))
+    if seconds > 60:
+        return "{:.0f}m".format(seconds / 60)
+    return "{:.0f}s".format(seconds)
 
 
 class ProgressBar:
-    def __init__(self, msg, n_total):
-        try:
-            _, self.columns = os.popen("stty size", "r").read().split()
-        except ValueError:
-            _, self.columns = (24, 80)  # noqa
+    """Progress of n_total runs with throughput, acceptance rate and ETA.
+
+    On a terminal the bar is redrawn at most every interval seconds. When
+    the output is not a terminal a plain log line is written every
+    log_interval seconds instead, so update can be called as often as
+    wanted. initial is the number of runs done before (when resuming), they
+    are not counted in the throughput."""
+
+    def __init__(
+        self,
+        msg: str,
+        n_total: int,
+        interval: float = 0.2,
+        log_interval: float = 30.0,
+        stream: Optional[IO[str]] = None,
+        initial: int = 0,
+    ) -> None:
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.columns = shutil.get_terminal_size().columns
         self.space_counter = len(str(n_total)) + 2
         self.msg = msg
-        print(msg)
         self.n_total = int(n_total)
-        self.create_time = time.time()
-        self.barlen = int(self.columns) - self.space_counter - 14
-        self.d = n_total / self.barlen
+        self.initial = initial
+        self.interval = interval if self.tty else log_interval
+        self.create_time = time.monotonic()
+        self.last_draw = self.create_time
+        self.stream.write(f"{msg}\n")
 
-    def done(self, msg=None):
-        if msg:
-            self.msg = msg
-        sys.stdout.write(("\r{:%s}" % self.columns).format(self.msg))
-        print()
-
-    def update(self, curr):
-        if curr == 0:
-            curr = 1
-        c = int(curr / self.d)
-        now = time.time()
-        pr_element = (now - self.create_time) / float(curr)
-        # p = curr / tot * 100
-
-        p = int(pr_element * (self.n_total - curr))
-
-        if p > 60 * 60:
-            time_msg = "{:3.0f}h".format((p / (60 * 60)))
-        elif p > 60:
-            time_msg = "{:3.0f}m".format((p / 60))
-        else:
-            time_msg = "{:3.0f}s".format(p)
+    def status(self, curr: int, attempts: Optional[int] = None) -> str:
+        """Throughput, acceptance rate and ETA after curr runs"""
+
+        elapsed = max(time.monotonic() - self.create_time, 1e-9)
+        rate = (curr - self.initial) / elapsed
+
+        msg = f"{rate:.0f} runs/s"
+        if attempts:
+            msg += f", {curr / attempts * 100:.1f}% accepted"
+        if rate:
+            msg += f", ETA {_duration((self.n_total - curr) / rate)}"
+        return msg
 
-        sys.stdout.write(
-            ("\r{:%s} [ {:%s} ] {}" % (self.space_counter, self.barlen)).format(
-                curr, c * "#", time_msg
+    def update(self, curr: int, attempts: Optional[int] = None) -> None:
+        """Report that curr runs are done (after attempts simulations). The
+        progress is only written if the interval has passed or all runs are
+        done"""
+
+        now = time.monotonic()
+        if now - self.last_draw < self.interval and curr < self.n_total:
+            return
+        self.last_draw = now
+
+        status = self.status(curr, attempts)
+
+        if not self.tty:
+            self.stream.write(
+                f"{self.msg}: {curr}/{self.n_total} "
+                f"({curr / max(1, self.n_total) * 100:.0f}%) {status}\n"
             )
+            self.stream.flush()
+            return
+
+        barlen = max(10, self.columns - self.space_counter - len(status) - 7)
+        filled = int(barlen * min(curr, self.n_total) / max(1, self.n_total))
+        line = ("\r{:%s} [ {:%s} ] {}" % (self.space_counter, barlen)).format(
+            curr, filled * "#", status
         )
+        self.stream.write(line[: self.columns + 1])
+        self.stream.flush()
+
+    def done(self, msg: Optional[str] = None) -> None:
+        """Finish the progress bar with msg"""
+
+        if msg:
+            self.msg = msg
+        if self.tty:
+            self.stream.write(("\r{:%s}\n" % self.columns).format(self.msg))
+        else:
+            self.stream.write(f"{self.msg}\n")
@@ -0,0 +1,106 @@
+"""Where montecarlo runs spend their time, and what happens to the chains"""
+
+import contextlib
+import time
+from collections import Counter
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Text,
+)
+
+
+class Profile:
+    """Seconds spent in each phase and counters of the chains run, and the
+    distinct agent bundles (bitmasks) accepted. Profiles
+    of the workers are merged into the profile of the main process, so the
+    seconds of the worker phases are summed over the workers"""
+
+    def __init__(self) -> None:
+        self.seconds: Counter = Counter()
+        self.attempts = 0
+        self.accepted = 0
+        self.rejected: Counter = Counter()
+        self.depth: Counter = Counter()
+        self.bundles: Set[int] = set()
+
+    def merge(self, other: "Profile") -> None:
+        """Add the timings and counters of other"""
+
+        self.seconds.update(other.seconds)
+        self.attempts += other.attempts
+        self.accepted += other.accepted
+        self.rejected.update(other.rejected)
+        self.depth.update(other.depth)
+        self.bundles |= other.bundles
+
+    @contextlib.contextmanager
+    def phase(self, name: Text) -> Iterator[None]:
+        """Time a block as phase name"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def timed(self, name: Text, func: Callable) -> Callable:
+        """Wrap func so its calls are timed as phase name"""
+
+        seconds = self.seconds
+
+        def wrapper(*args: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                seconds[name] += time.perf_counter() - start
+
+        return wrapper
+
+    def as_dict(self) -> Dict[Text, Any]:
+        """The profile as JSON data"""
+
+        return {
+            "seconds": dict(self.seconds),
+            "attempts": self.attempts,
+            "accepted": self.accepted,
+            "rejected": dict(self.rejected),
+            "depth": {str(depth): n for depth, n in sorted(self.depth.items())},
+            "distinct_bundles": len(self.bundles),
+        }
+
+    def tables(self) -> List[List[List[Any]]]:
+        """Rows of the phase, chain and chain depth tables"""
+
+        attempts = max(1, self.attempts)
+        phases = [
+            [name, round(seconds, 3)]
+            for name, seconds in sorted(
+                self.seconds.items(), key=lambda item: item[1], reverse=True
+            )
+        ]
+        chains = [
+            ["attempts", self.attempts, 100.0],
+            ["accepted", self.accepted, round(self.accepted / attempts * 100, 2)],
+        ]
+        chains += [
+            [f"rejected: {reason}", n, round(n / attempts * 100, 2)]
+            for reason, n in self.rejected.most_common()
+        ]
+        chains.append(["distinct bundles", len(self.bundles), None])
+        depths = [[depth, n] for depth, n in sorted(self.depth.items())]
+
+        return [phases, chains, depths]
+
+
+def phase(profile: Optional[Profile], name: Text) -> ContextManager:
+    """Time a block as phase name of profile, if profiling"""
+
+    return profile.phase(name) if profile else contextlib.nullcontext()
@@ -14,8 +14,18 @@ class AEPDataReader(datareader.DataReader):
     def iterate(self, filename: Text) -> Iterator[Dict[Text, List[Text]]]:
         """Iterate over a DEFIR data set"""
 
-        for bundle_file in glob(f"{filename}/*"):
-            with open(bundle_file, encoding="utf-8") as file_handle:
-                data = json.load(file_handle)
+        for bundle_file in self.parts(filename):
+            yield from self.iterate_part(bundle_file)
 
-                yield {Path(bundle_file).name: data.get("agents", [])}
+    def parts(self, filename: Text) -> Iterator[Text]:
+        """Each bundle file in the directory is a part"""
+
+        yield from glob(f"{filename}/*")
+
+    def iterate_part(self, part: Text) -> Iterator[Dict[Text, List[Text]]]:
+        """Read a single bundle file"""
+
+        with open(part, encoding="utf-8") as file_handle:
+            data = json.load(file_handle)
+
+            yield {Path(part).name: data.get("agents", [])}
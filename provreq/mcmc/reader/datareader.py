@@ -1,7 +1,20 @@
 """Abstract reader to support reading agents from different sources"""
 
+import hashlib
+import os
 from abc import ABC, abstractmethod
-from typing import Dict, Iterator, List, Text
+from typing import Any, Dict, Iterator, List, Optional, Text
+
+
+def file_digest(filename: Text) -> Text:
+    """sha256 of the content of a file"""
+
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
 
 
 class DataReader(ABC):
@@ -15,3 +28,23 @@ class DataReader(ABC):
         """read a file returning a list dictionaries of bundles of agent IDs'"""
 
         return list(self.iterate(filename))
+
+    def parts(self, filename: Text) -> Iterator[Any]:
+        """return parts of the data set that can be read independently of
+        each other with iterate_part. By default the data set is one part"""
+
+        yield filename
+
+    def iterate_part(self, part: Any) -> Iterator[Dict[Text, List[Text]]]:
+        """return an iterator over the bundles in one part of the data set"""
+
+        return self.iterate(part)
+
+    def part_digest(self, part: Any) -> Optional[Text]:
+        """return a digest of the content of a part, used to reuse the counts
+        of unchanged parts. None if the part can not be cached"""
+
+        if isinstance(part, str) and os.path.isfile(part):
+            return file_digest(part)
+
+        return None
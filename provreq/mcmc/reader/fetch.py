@@ -0,0 +1,88 @@
+"""Download files to a local cache, revalidating them with the server"""
+
+import hashlib
+import json
+import os
+import posixpath
+from typing import Dict, Optional, Text
+from urllib.parse import urlparse
+
+import requests
+
+
+def default_cache_dir() -> Text:
+    """Cache directory for downloads ($XDG_CACHE_HOME/provreq-mcmc)"""
+
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "provreq-mcmc",
+    )
+
+
+def cached_download(
+    url: Text,
+    cache_dir: Optional[Text] = None,
+    timeout: int = 30,
+    chunk_size: int = 1 << 20,
+) -> Text:
+    """Download url to the cache directory and return the local filename.
+
+    The file is streamed to disk in chunks. If it is already cached, the
+    server is asked if it has changed (ETag/Last-Modified) and the cached
+    copy is used if not, or if the server can not be reached."""
+
+    cache_dir = cache_dir or default_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    name = posixpath.basename(urlparse(url).path) or "download"
+    filename = os.path.join(
+        cache_dir, f"{hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]}-{name}"
+    )
+    meta_filename = f"{filename}.meta.json"
+
+    headers: Dict[Text, Text] = {}
+    if os.path.isfile(filename) and os.path.isfile(meta_filename):
+        with open(meta_filename, encoding="utf-8") as file_handle:
+            meta = json.load(file_handle)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with requests.get(
+            url, headers=headers, stream=True, timeout=timeout
+        ) as response:
+            if response.status_code == 304:
+                return filename
+            response.raise_for_status()
+
+            tmp_filename = f"{filename}.tmp{os.getpid()}"
+            try:
+                with open(tmp_filename, "wb") as file_handle:
+                    for chunk in response.iter_content(chunk_size):
+                        file_handle.write(chunk)
+                os.replace(tmp_filename, filename)
+            except BaseException:
+                # a partial download (failed or interrupted) is not kept
+                try:
+                    os.unlink(tmp_filename)
+                except FileNotFoundError:
+                    pass
+                raise
+
+            with open(meta_filename, "w", encoding="utf-8") as file_handle:
+                json.dump(
+                    {
+                        "url": url,
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                    },
+                    file_handle,
+                )
+    except requests.RequestException as err:
+        if not os.path.isfile(filename):
+            raise
+        print(f"Could not fetch {url} ({err}), using cached {filename}")
+
+    return filename
@@ -1,37 +1,41 @@
-import io
+import json
 import re
 import zipfile
 from pathlib import Path
-from typing import IO, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from typing import IO, Any, Dict, Iterator, List, Optional, Set, Tuple
 
-import requests
 import stix2.exceptions
 from provreq.mcmc.reader import datareader
+from provreq.mcmc.reader.fetch import cached_download
 from stix2 import parse
 from stix2.v20.bundle import Bundle
 
+PLAYBOOK_FILE = re.compile(r"/playbook_json/.*.json$")
+
 
 def file_zip(filename: str) -> Iterator[Tuple[str, IO[bytes]]]:
     """
     Open Zip File and yield (filename, file-like object) pairs
+    of the playbook files
     """
 
     with zipfile.ZipFile(filename) as zipreader:
         for zipinfo in zipreader.infolist():
+            if not PLAYBOOK_FILE.search(zipinfo.filename):
+                continue
             with zipreader.open(zipinfo) as zf_handle:
                 yield zipinfo.filename, zf_handle
 
 
-def url_zip(url: str) -> Iterator[Tuple[str, IO[bytes]]]:
+def url_zip(
+    url: str, download_dir: Optional[str] = None
+) -> Iterator[Tuple[str, IO[bytes]]]:
     """
-    Download a ZIP file and extract its contents in memory
-    yields (filename, file-like object) pairs
+    Download a ZIP file to the local cache (or reuse the cached copy)
+    yields (filename, file-like object) pairs of the playbook files
     """
-    response = requests.get(url, timeout=30)
-    with zipfile.ZipFile(io.BytesIO(response.content)) as zipreader:
-        for zipinfo in zipreader.infolist():
-            with zipreader.open(zipinfo) as zf_handle:
-                yield zipinfo.filename, zf_handle
+
+    yield from file_zip(cached_download(url, download_dir))
 
 
 def playbook_agents(playbook: Bundle) -> Set[str]:
@@ -53,46 +57,101 @@ def playbook_agents(playbook: Bundle) -> Set[str]:
     return agents
 
 
-def _get_reader(
-    playbook_file: str,
-) -> Callable[[str], Iterator[Tuple[str, IO[bytes]]]]:
-    """figure out the correct reader based on the filename"""
+def raw_playbook_agents(playbook: Dict[str, Any]) -> Set[str]:
+    """Return the agents referenced in a playbook read as plain JSON, without
+    creating (and validating) the stix2 objects"""
 
-    if playbook_file.startswith("http"):
-        return url_zip
-    return file_zip
+    agents: Set[str] = set()
+    for obj in playbook.get("objects", []):
+        if obj.get("type") == "attack-pattern":
+            agents.update(
+                ref["external_id"]
+                for ref in obj.get("external_references", [])
+                if ref.get("source_name") == "mitre-attack" and "external_id" in ref
+            )
+    return agents
 
 
-def _extract_playbook_agents(file, filename) -> Optional[Dict[str, List[str]]]:
-    """check if the filename conforms to a playbook file, if so extract the agents used"""
+def _extract_playbook_agents(
+    file, filename, validate: bool = False
+) -> Optional[Dict[str, List[str]]]:
+    """check if the filename conforms to a playbook file, if so extract the agents used.
+    With validate the playbook is parsed with stix2, otherwise as plain JSON"""
 
-    print(f"Trying {filename}")
-    if re.search(r"/playbook_json/.*.json$", filename):
+    if PLAYBOOK_FILE.search(filename):
         try:
-            playbook = parse(file, allow_custom=True)
+            if validate:
+                agents = playbook_agents(parse(file, allow_custom=True))
+            else:
+                agents = raw_playbook_agents(json.load(file))
             print(f"Parsing {filename}")
-        except stix2.exceptions.InvalidValueError as err:
+        except (stix2.exceptions.InvalidValueError, ValueError) as err:
             print(
                 f"u42 reader: _extract_playbook_agents: Could not parse {filename} -> {err}"
             )
             return None
 
-        agents = playbook_agents(playbook)
         return {Path(filename).name: list(agents)}
     return None
 
 
 class U42PlaybookDataReader(datareader.DataReader):
-    """Read a U42 Playbook file of campaigns with agents"""
+    """Read a U42 Playbook file of campaigns with agents. Zip files given as
+    an URL are downloaded to download_dir (default ~/.cache/provreq-mcmc).
+    The playbooks are read as plain JSON unless validate is set, then they
+    are parsed (and validated) as stix2 bundles"""
+
+    def __init__(
+        self, download_dir: Optional[str] = None, validate: bool = False
+    ) -> None:
+        self.download_dir = download_dir
+        self.validate = validate
+
+    def _local_zip(self, filename: str) -> str:
+        """Local filename of the zip file, downloading it if it is an URL"""
+
+        if filename.startswith("http"):
+            return cached_download(filename, self.download_dir)
+        return filename
 
     def iterate(self, filename: str) -> Iterator[Dict[str, List[str]]]:
         """Iterate over a playbooks' data set"""
 
-        zip_reader = _get_reader(filename)
-
-        for content_filename, file in zip_reader(filename):
-            agents = _extract_playbook_agents(file, content_filename)
+        for content_filename, file in file_zip(self._local_zip(filename)):
+            agents = _extract_playbook_agents(file, content_filename, self.validate)
             if agents:
                 yield agents
             else:
                 print(f"Skipping {content_filename}, no return from parser")
+
+    def parts(self, filename: str) -> Iterator[Any]:
+        """Each playbook in the zip file is a part, (zip filename,
+        playbook filename). URLs are downloaded to the local cache first"""
+
+        filename = self._local_zip(filename)
+        with zipfile.ZipFile(filename) as zipreader:
+            for content_filename in zipreader.namelist():
+                if PLAYBOOK_FILE.search(content_filename):
+                    yield filename, content_filename
+
+    def part_digest(self, part: Any) -> Optional[str]:
+        """The CRC and size of a playbook in a zip file (and if it is
+        validated, as invalid playbooks are skipped then)"""
+
+        filename, content_filename = part
+        with zipfile.ZipFile(filename) as zipreader:
+            info = zipreader.getinfo(content_filename)
+
+        return f"{info.CRC:08x}-{info.file_size}-{int(self.validate)}"
+
+    def iterate_part(self, part: Any) -> Iterator[Dict[str, List[str]]]:
+        """Read a single playbook from a zip file"""
+
+        filename, content_filename = part
+        with zipfile.ZipFile(filename) as zipreader:
+            with zipreader.open(content_filename) as file:
+                agents = _extract_playbook_agents(file, content_filename, self.validate)
+        if agents:
+            yield agents
+        else:
+            print(f"Skipping {content_filename}, no return from parser")
@@ -0,0 +1,81 @@
+"""On-disk cache of montecarlo results"""
+
+import gzip
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional, Text
+
+# Bump when the content of the cached results changes
+VERSION = 2
+
+
+class ResultCache:
+    """Content addressed cache of montecarlo results in a directory, as
+    gzip'd JSON.
+
+    Results are keyed by the hashes of the files the model is made from and
+    the normalized query parameters. Reading an entry marks it as recently
+    used, and the least recently used entries are removed when the files
+    in the directory use more than max_bytes."""
+
+    def __init__(self, directory: Text, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(sources: Dict[Text, Text], params: Dict[Text, Any]) -> Text:
+        """Key of the result of the query params on a model made from sources
+        (name -> hash)"""
+
+        return hashlib.sha256(
+            json.dumps([VERSION, sources, params], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def _filename(self, key: Text) -> Text:
+        return os.path.join(self.directory, f"{key}.json.gz")
+
+    def get(self, key: Text) -> Optional[Dict[Text, Any]]:
+        """The cached result, or None"""
+
+        filename = self._filename(key)
+        try:
+            with gzip.open(filename, "rt", encoding="utf-8") as file_handle:
+                result: Dict[Text, Any] = json.load(file_handle)
+            os.utime(filename)
+        except (OSError, EOFError, ValueError):
+            return None
+
+        return result
+
+    def put(self, key: Text, result: Dict[Text, Any]) -> None:
+        """Store a result and evict the least recently used entries if the
+        cache is too large"""
+
+        filename = self._filename(key)
+        tmp_filename = f"{filename}.tmp{os.getpid()}"
+        with gzip.open(tmp_filename, "wt", encoding="utf-8") as file_handle:
+            json.dump(result, file_handle)
+        os.replace(tmp_filename, filename)
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits"""
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json.gz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:  # removed by another process
+                pass
+            total -= size
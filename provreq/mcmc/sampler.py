@@ -0,0 +1,62 @@
+"""Weighted samplers used to draw providers of promises in the montecarlo simulation"""
+
+import bisect
+import random
+from typing import Any, Dict, List, Sequence
+
+
+class WeightedSampler:
+    """Draw items with a probability proportional to an integer weight.
+
+    A draw picks a random integer below the total weight and bisects the
+    cumulative weights. This gives exactly the same distribution as
+    random.choice over a list where every item is repeated weight times,
+    using memory proportional to the number of distinct items."""
+
+    __slots__ = ("items", "cumulative", "total")
+
+    def __init__(self, items: Sequence[Any], cumulative: Sequence[int]) -> None:
+        self.items = items
+        self.cumulative = cumulative
+        self.total = cumulative[-1] if len(cumulative) else 0
+
+    @classmethod
+    def from_counts(cls, counts: Dict[Any, int]) -> "WeightedSampler":
+        """Create a sampler from a dictionary of item -> count"""
+
+        items: List[Any] = []
+        cumulative: List[int] = []
+        total = 0
+        for item, count in counts.items():
+            if count <= 0:
+                continue
+            total += count
+            items.append(item)
+            cumulative.append(total)
+
+        return cls(items, cumulative)
+
+    def counts(self) -> Dict[Any, int]:
+        """Return the dictionary of item -> count the sampler was created from"""
+
+        res = {}
+        prev = 0
+        for item, cum in zip(self.items, self.cumulative):
+            res[item] = cum - prev
+            prev = cum
+
+        return res
+
+    def sample(self, rng: Any = random) -> Any:
+        """Draw a random item, rng must implement randrange
+        (random.Random or the random module)"""
+
+        return self.items[
+            bisect.bisect_right(self.cumulative, rng.randrange(self.total))
+        ]
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __bool__(self) -> bool:
+        return self.total > 0
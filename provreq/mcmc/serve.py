@@ -0,0 +1,384 @@
+"""Query server keeping the model loaded between montecarlo and backsolve
+queries.
+
+The server answers JSON requests over HTTP, on a TCP port or a Unix socket:
+
+    POST   /montecarlo     query spec as for provreq-mcmc-batch, plus an
+                           optional "timeout" (seconds)
+    POST   /backsolve      {"agents": [...]}
+    GET    /queries        ids of the running montecarlo queries
+    DELETE /queries/<id>   cancel a running montecarlo query
+
+Runs and time of each query are limited by --max-runs and --max-seconds.
+The model is reloaded (and recompiled with --model) when one of the files
+it is made from changes."""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Text, Tuple
+
+from provreq.tools import config
+
+import provreq.mcmc.model
+from provreq.mcmc.backsolve import backsolve_rounds
+from provreq.mcmc.batch import add_query_arguments, run_query
+from provreq.mcmc.montecarlo import setup_worker
+from provreq.mcmc.resultcache import ResultCache
+
+
+def command_line_arguments() -> argparse.Namespace:
+    """Parse the command line arguments"""
+
+    parser = config.common_args("AEP Cyberhunt Requirements query server")
+
+    add_query_arguments(parser)
+
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Listen on host")
+
+    parser.add_argument("--port", type=int, default=8000, help="Listen on port")
+
+    parser.add_argument(
+        "--socket", type=str, help="Listen on this Unix socket instead of a port"
+    )
+
+    parser.add_argument(
+        "--max-runs",
+        type=int,
+        default=1_000_000,
+        help="Max number of runs of a query, default: 1000000",
+    )
+
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=60.0,
+        help="Max time used by a query, default: 60",
+    )
+
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between checks for changed model files, default: 5",
+    )
+
+    args: argparse.Namespace = config.handle_args(parser, "generate")
+
+    return args
+
+
+def init_server_worker(*args: Any) -> None:
+    """Pool initializer, leave ctrl-c to the server. SIGTERM is kept, as
+    the pool is terminated with it on shutdown"""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_worker(*args)
+
+
+class Model:
+    """The loaded agents and graph, and the worker pool simulating on them.
+
+    A model in use by queries is kept (with its pool) until the last of
+    them is done, even if a newer model has replaced it."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        stats = provreq.mcmc.model.stats_file(args)
+        self.sources = provreq.mcmc.model.source_files(args, stats)
+        self.mtimes = self.source_mtimes()
+        self.hashes = provreq.mcmc.model.source_hashes(self.sources)
+        self.agents, self.graph = provreq.mcmc.model.load_model(args, stats)
+        self.stats = self.graph.stats()
+        self.workers = max(1, args.workers)
+        self.loaded = time.time()
+
+        # always a pool, as queries from concurrent requests can not share
+        # the simulation state of one process
+        self.lock = threading.Lock()
+        self.pool: Optional[Any] = multiprocessing.Pool(
+            self.workers,
+            initializer=init_server_worker,
+            initargs=(self.graph, self.agents, args.engine, args.validation_cache_size),
+        )
+
+        self.users = 0
+        self.retired = False
+
+    def source_mtimes(self) -> Dict[Text, float]:
+        """Modification time of the files the model is made from"""
+
+        return {
+            name: os.stat(filename).st_mtime for name, filename in self.sources.items()
+        }
+
+    def changed(self) -> bool:
+        """True if one of the source files has changed since loading"""
+
+        try:
+            return self.source_mtimes() != self.mtimes
+        except OSError:  # being replaced, check again later
+            return False
+
+    def acquire(self) -> None:
+        """Mark the model as used by a query"""
+
+        with self.lock:
+            self.users += 1
+
+    def release(self) -> None:
+        """Mark a query as done, and stop the pool of a retired model"""
+
+        with self.lock:
+            self.users -= 1
+            self._close()
+
+    def retire(self) -> None:
+        """The model is replaced, stop the pool when no queries use it"""
+
+        with self.lock:
+            self.retired = True
+            self._close()
+
+    def _close(self) -> None:
+        if self.retired and not self.users and self.pool:
+            self.pool.close()
+            self.pool = None
+
+
+class QueryServer:
+    """The current model and the running queries"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.model = Model(args)
+        self.lock = threading.Lock()
+        self.queries: Dict[Text, threading.Event] = {}
+        self.cache = (
+            ResultCache(args.result_cache, args.result_cache_size * 1024 * 1024)
+            if args.result_cache
+            else None
+        )
+
+    def current(self) -> Model:
+        """The current model, marked as in use"""
+
+        with self.lock:
+            self.model.acquire()
+            return self.model
+
+    def reload(self) -> None:
+        """Replace the model if its source files have changed"""
+
+        if not self.model.changed():
+            return
+
+        print("Model files changed, reloading")
+        try:
+            model = Model(self.args)
+        except (OSError, ValueError, KeyError) as err:
+            print(f"Unable to reload model: {err}")
+            return
+
+        with self.lock:
+            old, self.model = self.model, model
+        old.retire()
+
+    def watch(self) -> None:
+        """Check for changed model files every --reload-interval seconds"""
+
+        while True:
+            time.sleep(self.args.reload_interval)
+            self.reload()
+
+    def montecarlo(self, spec: Dict[Text, Any]) -> Dict[Text, Any]:
+        """Run a montecarlo query within the run and time limits"""
+
+        query_id = str(spec.get("id") or uuid.uuid4().hex)
+        spec = {
+            **spec,
+            "runs": min(spec.get("runs", self.args.runs), self.args.max_runs),
+        }
+        deadline = time.monotonic() + min(
+            spec.get("timeout", self.args.max_seconds), self.args.max_seconds
+        )
+
+        cancelled = threading.Event()
+        with self.lock:
+            if query_id in self.queries:
+                raise ValueError(f"Query {query_id} is already running")
+            self.queries[query_id] = cancelled
+
+        model = self.current()
+        try:
+            result = run_query(
+                spec,
+                self.args,
+                model.agents,
+                model.graph,
+                model.workers,
+                model.pool,
+                lambda: cancelled.is_set() or time.monotonic() > deadline,
+                self.cache,
+                model.hashes,
+            )
+        finally:
+            model.release()
+            with self.lock:
+                del self.queries[query_id]
+
+        return {"id": query_id, "cancelled": cancelled.is_set(), **result}
+
+    def backsolve(self, spec: Dict[Text, Any]) -> Dict[Text, Any]:
+        """Backsolve from the agents in spec"""
+
+        model = self.current()
+        try:
+            unknown = [agent for agent in spec["agents"] if agent not in model.agents]
+            if unknown:
+                raise ValueError(f"Unknown agents: {', '.join(unknown)}")
+            rounds = backsolve_rounds(model.stats, model.agents, spec["agents"])
+        finally:
+            model.release()
+
+        return {
+            "rounds": [
+                [
+                    {"agent": agent, "name": model.agents[agent]["name"]}
+                    for agent in agents
+                ]
+                for agents in rounds
+            ]
+        }
+
+    def cancel(self, query_id: Text) -> bool:
+        """Cancel a running query, return False if it is not running"""
+
+        with self.lock:
+            cancelled = self.queries.get(query_id)
+        if cancelled is None:
+            return False
+        cancelled.set()
+        return True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """JSON API of the query server"""
+
+    app: QueryServer
+
+    def address_string(self) -> str:
+        # client_address is empty on Unix sockets
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def reply(self, status: int, data: Dict[Text, Any]) -> None:
+        """Send data as a JSON response"""
+
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path != "/queries":
+            self.reply(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        with self.app.lock:
+            running = list(self.app.queries)
+            loaded = self.app.model.loaded
+        self.reply(200, {"queries": running, "model_loaded": loaded})
+
+    def do_POST(self) -> None:
+        handlers = {
+            "/montecarlo": self.app.montecarlo,
+            "/backsolve": self.app.backsolve,
+        }
+        if self.path not in handlers:
+            self.reply(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            spec = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(spec, dict):
+                raise ValueError("The query must be a JSON object")
+            self.reply(200, handlers[self.path](spec))
+        except (KeyError, TypeError, ValueError) as err:
+            self.reply(400, {"error": str(err)})
+
+    def do_DELETE(self) -> None:
+        prefix = "/queries/"
+        if not self.path.startswith(prefix):
+            self.reply(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        query_id = self.path[len(prefix) :]
+        if self.app.cancel(query_id):
+            self.reply(202, {"id": query_id, "cancelled": True})
+        else:
+            self.reply(404, {"error": f"Query {query_id} is not running"})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    """HTTP server on a Unix socket"""
+
+    daemon_threads = True
+
+
+def _shutdown(sig: int, frame: Any) -> None:
+    """Stop serving on ctrl-c/SIGTERM"""
+
+    raise KeyboardInterrupt
+
+
+def main() -> None:
+    """main entry point"""
+
+    args = command_line_arguments()
+
+    # queries are stopped by cancellation, not by the montecarlo ctrl-c handler
+    signal.signal(signal.SIGINT, _shutdown)
+    signal.signal(signal.SIGTERM, _shutdown)
+
+    app = QueryServer(args)
+    handler = type("Handler", (RequestHandler,), {"app": app})
+
+    server: Any
+    address: Tuple[Any, ...]
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, handler)
+        address = (args.socket,)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        address = (args.host, args.port)
+
+    threading.Thread(target=app.watch, daemon=True).start()
+
+    print(f"Serving on {':'.join(str(part) for part in address)}")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.unlink(args.socket)
+        if app.model.pool:
+            app.model.pool.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Fixed memory summaries of the paths (agent bitmasks) of long runs: the
+heavy hitters (the paths with the most runs) with bounds on their counts,
+and a count-min sketch of the runs of every path"""
+
+import hashlib
+import heapq
+from array import array
+from collections import Counter
+from typing import List, Tuple
+
+from provreq.mcmc.graph import bits
+
+# rows of the count-min sketch, one 64 bit word of a blake2b digest each
+DEPTH = 4
+
+
+class CountMinSketch:
+    """Count-min sketch of the runs of each path. An estimate is never below
+    the runs of the path, and with probability 1 - e^-depth it is at most
+    e / width of all the runs above"""
+
+    def __init__(self, width: int, depth: int = DEPTH) -> None:
+        self.width = width
+        self.depth = depth
+        self.rows = [array("q", bytes(8 * width)) for _ in range(depth)]
+
+    def _columns(self, sim: int) -> List[int]:
+        """The column of a path in each row. blake2b, as hash() of large
+        ints is periodic and of bytes differs between processes"""
+
+        digest = hashlib.blake2b(
+            sim.to_bytes((sim.bit_length() + 7) // 8, "little"),
+            digest_size=8 * self.depth,
+        ).digest()
+
+        return [
+            int.from_bytes(digest[row * 8 : row * 8 + 8], "little") % self.width
+            for row in range(self.depth)
+        ]
+
+    def add(self, sim: int, n: int = 1) -> None:
+        """Add n runs of a path"""
+
+        for row, column in zip(self.rows, self._columns(sim)):
+            row[column] += n
+
+    def estimate(self, sim: int) -> int:
+        """Upper bound of the runs of a path"""
+
+        return min(row[column] for row, column in zip(self.rows, self._columns(sim)))
+
+
+class HeavyHitters:
+    """Misra-Gries summary of the paths, merged batch by batch: when more
+    than capacity paths are kept, the count of the path after the top
+    capacity is subtracted from all of them and the paths at or below it
+    are dropped. The counts are never above the runs of a path and at most
+    error below, and error is at most total / (capacity + 1). The runs of
+    each agent are counted exactly, as there are few agents"""
+
+    def __init__(self, capacity: int, width: int = 0) -> None:
+        self.capacity = capacity
+        self.counts: Counter = Counter()
+        self.error = 0
+        self.total = 0
+        self.agent_runs: Counter = Counter()
+        self.sketch = CountMinSketch(width or max(1024, 4 * capacity))
+
+    def update(self, paths: Counter) -> None:
+        """Add paths (bitmask -> runs), the exact counts of a batch"""
+
+        counts = self.counts
+        agent_runs = self.agent_runs
+        sketch = self.sketch
+        for sim, n in paths.items():
+            counts[sim] += n
+            self.total += n
+            sketch.add(sim, n)
+            for idx in bits(sim):
+                agent_runs[idx] += n
+
+        if len(counts) > self.capacity:
+            self._reduce()
+
+    def _reduce(self) -> None:
+        """Keep the top capacity paths, less the count of the next path"""
+
+        counts = self.counts
+        threshold = heapq.nlargest(self.capacity + 1, counts.values())[-1]
+        kept = {sim: n - threshold for sim, n in counts.items() if n > threshold}
+        self.error += threshold
+        # in place, as the counter is also used as Run.paths
+        counts.clear()
+        counts.update(kept)
+
+    def bounds(self, sim: int) -> Tuple[int, int]:
+        """Lower and upper bound of the runs of a path"""
+
+        count = self.counts.get(sim, 0)
+        return count, min(count + self.error, self.sketch.estimate(sim))
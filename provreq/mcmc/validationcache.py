@@ -0,0 +1,61 @@
+"""Cache of validation results for simulated agent bundles"""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional
+
+
+class ValidationCache:
+    """LRU cache of validation results keyed by the canonical agent bundle.
+
+    Both accepted (positive) and rejected (negative) bundles are stored, so
+    a bundle is only validated again if it was evicted. entries learned
+    since the last call to take_learned are kept, so they can be shared
+    with caches in other processes."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Hashable, bool]" = OrderedDict()
+        self.learned: Dict[Hashable, bool] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def validate(self, bundle: Hashable, validator: Callable[[], bool]) -> bool:
+        """Return the cached result for bundle, or call validator and cache
+        the result"""
+
+        valid: Optional[bool] = self.entries.get(bundle)
+        if valid is not None:
+            self.hits += 1
+            self.entries.move_to_end(bundle)
+            return valid
+
+        self.misses += 1
+        valid = validator()
+        self.add(bundle, valid)
+        self.learned[bundle] = valid
+        return valid
+
+    def add(self, bundle: Hashable, valid: bool) -> None:
+        """Add a validation result, evicting the least recently used entries"""
+
+        self.entries[bundle] = valid
+        self.entries.move_to_end(bundle)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def update(self, learned: Dict[Hashable, bool]) -> None:
+        """Add validation results learned by other caches"""
+
+        for bundle, valid in learned.items():
+            if bundle not in self.entries:
+                self.add(bundle, valid)
+
+    def take_learned(self) -> Dict[Hashable, bool]:
+        """Return and reset the results validated since the last call"""
+
+        learned = self.learned
+        self.learned = {}
+        return learned
+
+    def __len__(self) -> int:
+        return len(self.entries)
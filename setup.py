@@ -26,11 +26,19 @@ setup(
             "provreq-mcmc-backsolve= provreq.mcmc.backsolve:main",
             "provreq-mcmc-statistics= provreq.mcmc.stats:main",
             "provreq-mcmc-montecarlo= provreq.mcmc.montecarlo:main",
+            "provreq-mcmc-compile= provreq.mcmc.model:main",
+            "provreq-mcmc-batch= provreq.mcmc.batch:main",
+            "provreq-mcmc-serve= provreq.mcmc.serve:main",
         ]
     },
     # https://packaging.python.org/guides/packaging-namespace-packages/#pkgutil-style-namespace-packages
     namespace_packages=["provreq"],
-    packages=["provreq.mcmc", "provreq.mcmc.aggregators"],
+    packages=[
+        "provreq.mcmc",
+        "provreq.mcmc.aggregators",
+        "provreq.mcmc.mappings",
+        "provreq.mcmc.reader",
+    ],
     url="https://github.com/mnemonic-no/provreq-mcmc",
     install_requires=[
         "caep",
@@ -40,6 +48,9 @@ setup(
         "requests",
         "tabulate",
     ],
+    extras_require={
+        "numpy": ["numpy>=1.17"],
+    },
     python_requires=">=3.8, <4",
     classifiers=[
         "Development Status :: 4 - Beta",
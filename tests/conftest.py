@@ -0,0 +1,39 @@
+"""Fixtures shared by the tests, a small synthetic model from the
+benchmarks"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+import synthetic  # noqa: E402
+
+from provreq.mcmc.graph import AgentGraph  # noqa: E402
+from provreq.mcmc.montecarlo import Query  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def model() -> synthetic.Synthetic:
+    """Synthetic model of 120 agents"""
+
+    return synthetic.generate(120, 6, 2, 2, 0.2, 0.05, 1)
+
+
+@pytest.fixture(scope="session")
+def graph(model: synthetic.Synthetic) -> AgentGraph:
+    """The compiled graph of model"""
+
+    return AgentGraph.compile(model.agents, model.stats)
+
+
+@pytest.fixture(scope="session")
+def query(model: synthetic.Synthetic, graph: AgentGraph) -> Query:
+    """Query from the seeds of model to its target and first stop agent"""
+
+    return Query(
+        tuple(model.seeds),
+        graph.agent_mask([model.target]),
+        graph.agent_mask(model.stop_agents[:1]),
+    )
@@ -0,0 +1,21 @@
+"""Paths aggregated as they are recorded, and at the end (--raw-paths)"""
+
+import pytest
+
+from provreq.mcmc.aggregators.online import path_aggregation
+from provreq.mcmc.montecarlo import Run, setup_worker, worker_rng_states
+
+
+@pytest.mark.parametrize("strategy", ["children", "equivalence"])
+def test_online_aggregation_matches_raw_paths(model, graph, query, strategy):
+    setup_worker(graph, model.agents)
+    aggregation = path_aggregation(graph, model.agents, strategy)
+
+    raw = Run(query, worker_rng_states(3, 1))
+    raw.batch(2000)
+
+    online = Run(query._replace(aggregation=strategy), worker_rng_states(3, 1))
+    online.batch(2000)
+
+    assert len(online.paths) < len(raw.paths)
+    assert aggregation.remap(online.paths) == aggregation.remap(raw.paths)
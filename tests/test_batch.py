@@ -0,0 +1,77 @@
+"""Records of the batch queries"""
+
+import argparse
+import json
+
+import pytest
+
+from provreq.mcmc.batch import add_query_arguments, query_record
+from provreq.mcmc.montecarlo import setup_worker
+
+
+@pytest.fixture
+def record(model, graph):
+    """query_record of a line, with the default arguments"""
+
+    parser = argparse.ArgumentParser()
+    add_query_arguments(parser)
+    args = parser.parse_args([])
+    setup_worker(graph, model.agents)
+
+    return lambda line_no, line: query_record(
+        line_no, line, args, model.agents, graph, 1
+    )
+
+
+def spec(model, **kwargs):
+    """A valid query spec of model as a JSON line"""
+
+    return json.dumps(
+        {
+            "agents": [model.target],
+            "seeds": model.seeds,
+            "stop_agents": model.stop_agents[:1],
+            "runs": 200,
+            "random_seed": 1,
+            **kwargs,
+        }
+    )
+
+
+def test_valid_query(model, record):
+    result = record(1, spec(model, id="ok"))
+
+    assert result["id"] == "ok"
+    assert "error" not in result
+    assert result["runs"] == 200
+
+
+@pytest.mark.parametrize(
+    "line, error",
+    [
+        ("{bad json", "Expecting property name"),
+        ("[1, 2]", "The query must be a JSON object"),
+        ('"query"', "The query must be a JSON object"),
+    ],
+)
+def test_invalid_lines_are_error_records(record, line, error):
+    result = record(7, line)
+
+    assert result["id"] == 7
+    assert result["error"].startswith(error)
+
+
+@pytest.mark.parametrize(
+    "kwargs, error",
+    [
+        ({"runs": "200"}, "runs must be an integer"),
+        ({"top": True}, "top must be an integer"),
+        ({"converge": "0.01"}, "converge must be a number"),
+        ({"agents": []}, "Agents can not be empty"),
+        ({"agents": ["unknown"]}, "Unknown agents: unknown"),
+    ],
+)
+def test_invalid_queries_are_error_records(model, record, kwargs, error):
+    result = record(3, spec(model, id="bad", **kwargs))
+
+    assert result == {"id": "bad", "error": error}
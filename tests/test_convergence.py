@@ -0,0 +1,22 @@
+"""Convergence monitor"""
+
+from collections import Counter
+
+from provreq.mcmc.convergence import ConvergenceMonitor
+
+
+def test_restored_monitor_continues_the_checks():
+    paths = Counter({1: 500, 2: 300, 3: 200})
+    chokes = Counter({4: 3, 5: 2})
+
+    monitor = ConvergenceMonitor(2, 0.01, every=1, min_runs=0, z=100)
+    for _ in range(3):
+        assert not monitor.check(paths, chokes, 1000)
+
+    restored = ConvergenceMonitor(2, 0.01, every=1, min_runs=0, z=100)
+    restored.restore(monitor.state())
+
+    # the third check in a row with the same rankings converges, for both
+    assert monitor.check(paths, chokes, 1000)
+    assert restored.check(paths, chokes, 1000)
+    assert restored.reason == monitor.reason
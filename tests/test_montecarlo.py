@@ -0,0 +1,110 @@
+"""Seeded runs of the montecarlo engines"""
+
+from collections import Counter
+from typing import Any, Dict, Text
+
+import pytest
+
+from provreq.mcmc import checkpoint, montecarlo
+from provreq.mcmc.graph import AgentGraph, bits
+from provreq.mcmc.montecarlo import (
+    Query,
+    Run,
+    choke_counts,
+    setup_worker,
+    worker_rng_states,
+)
+from provreq.mcmc.sketch import HeavyHitters
+
+ENGINES = ["reference", "numpy"]
+
+
+def seeded_run(
+    graph: AgentGraph,
+    agents: Dict,
+    query: Query,
+    engine: Text,
+    stop: Any = None,
+) -> Run:
+    """Run of 1000 accepted simulations with two random streams, in batches
+    of 250"""
+
+    if engine == "numpy":
+        pytest.importorskip("numpy")
+
+    setup_worker(graph, agents, engine)
+    run = Run(query, worker_rng_states(7, 2))
+    while run.accepted < 1000:
+        run.batch(250, stop=stop)
+
+    return run
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_seeded_runs_are_reproducible(model, graph, query, engine):
+    first = seeded_run(graph, model.agents, query, engine)
+    second = seeded_run(graph, model.agents, query, engine)
+
+    assert first.accepted == second.accepted == 1000
+    assert first.paths == second.paths
+    assert first.missing == second.missing
+    assert first.attempted == second.attempted
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_sliced_runs_match_unsliced(model, graph, query, engine, monkeypatch):
+    unsliced = seeded_run(graph, model.agents, query, engine)
+
+    # every share returns after the first 64 attempts
+    monkeypatch.setattr(montecarlo, "SLICE_SECONDS", 0.0)
+    sliced = seeded_run(graph, model.agents, query, engine, stop=lambda: False)
+
+    assert sliced.paths == unsliced.paths
+    assert sliced.missing == unsliced.missing
+    assert sliced.attempted == unsliced.attempted
+    assert sliced.rng_states == unsliced.rng_states
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_resume_in_the_middle_of_a_batch(
+    model, graph, query, engine, monkeypatch, tmp_path
+):
+    unsliced = seeded_run(graph, model.agents, query, engine)
+
+    # stop after the first slice of the second batch
+    monkeypatch.setattr(montecarlo, "SLICE_SECONDS", 0.0)
+    stopped = Run(query, worker_rng_states(7, 2))
+    stopped.batch(250)
+    stopped.batch(250, stop=lambda: True)
+    assert any(stopped.owed)
+
+    filename = str(tmp_path / "checkpoint")
+    checkpoint.save(filename, stopped.state())
+
+    resumed = Run(query, worker_rng_states(None, 2))
+    resumed.restore(checkpoint.load(filename))
+    while resumed.accepted < 1000:
+        resumed.batch(250)
+
+    assert resumed.paths == unsliced.paths
+    assert resumed.missing == unsliced.missing
+    assert resumed.attempted == unsliced.attempted
+
+
+def test_chokes_of_a_summary_are_the_runs_of_the_agents(model, graph, query):
+    setup_worker(graph, model.agents)
+    choke_mask = (1 << len(graph.agent_ids)) - 1 & ~query.base
+
+    exact = Run(query, worker_rng_states(7, 1), choke_mask=choke_mask)
+    exact.batch(1000)
+    assert exact.chokes == choke_counts(exact.paths, choke_mask)
+
+    summary = Run(
+        query, worker_rng_states(7, 1), summary=HeavyHitters(10), choke_mask=choke_mask
+    )
+    summary.batch(1000)
+    runs = Counter()
+    for sim, count in exact.paths.items():
+        for idx in bits(sim & choke_mask):
+            runs[idx] += count
+    assert summary.chokes == runs
@@ -0,0 +1,25 @@
+"""Weighted sampler"""
+
+import random
+
+from provreq.mcmc.sampler import WeightedSampler
+
+COUNTS = {"a": 3, "b": 1, "c": 0, "d": 6}
+
+
+def test_counts_round_trip():
+    sampler = WeightedSampler.from_counts(COUNTS)
+
+    assert sampler.counts() == {"a": 3, "b": 1, "d": 6}
+    assert sampler.total == 10
+    assert not WeightedSampler.from_counts({"a": 0})
+
+
+def test_same_draws_as_random_choice():
+    sampler = WeightedSampler.from_counts(COUNTS)
+    repeated = [item for item, count in COUNTS.items() for _ in range(count)]
+
+    rng_sampler = random.Random(1)
+    rng_choice = random.Random(1)
+    for _ in range(10_000):
+        assert sampler.sample(rng_sampler) == rng_choice.choice(repeated)